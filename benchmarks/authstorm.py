@@ -0,0 +1,95 @@
+#!/usr/bin/python
+"""Login storm against a hanging authentication backend
+
+Runs many concurrent logins, each from its own address so no throttling
+applies, through authTimeout's worker pool to a local stand-in for an
+LDAP or RADIUS server that never answers (or answers after --delay
+seconds).  Reports how the logins ended and how many threads are left
+behind, which must stay within the pool's size however many logins
+are tried:
+
+    python benchmarks/authstorm.py --logins 500
+    python benchmarks/authstorm.py --delay 0.05 --workers 4
+
+Exits with status 1 if more threads than the pool's workers are left.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telnetsrv.auth import WorkerPool, AuthBusy, AuthTimeout
+
+
+class StandInBackend(object):
+    '''Authentication server stand-in: answers after delay seconds, or never.'''
+    def __init__(self, delay=None):
+        self.delay = delay
+        self.released = threading.Event()
+
+    def __call__(self, username, password):
+        if self.delay is None:
+            self.released.wait()
+        else:
+            time.sleep(self.delay)
+
+
+def storm(pool, backend, logins, timeout):
+    '''Run the logins at once, return the count of each outcome.'''
+    outcomes = {'ok': 0, 'timeout': 0, 'busy': 0}
+    lock = threading.Lock()
+    def login(n):
+        try:
+            pool.call(timeout, backend, 'user%d' % n, 'secret')
+            outcome = 'ok'
+        except AuthBusy:
+            outcome = 'busy'
+        except AuthTimeout:
+            outcome = 'timeout'
+        lock.acquire()
+        outcomes[outcome] += 1
+        lock.release()
+    threads = [threading.Thread(target=login, args=(n, )) for n in range(logins)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Storm a hanging authentication backend with logins.')
+    parser.add_argument('-n', '--logins', type=int, default=200, help='Concurrent logins.')
+    parser.add_argument('--workers', type=int, default=8, help='Worker threads in the pool.')
+    parser.add_argument('--queue', type=int, default=32, help='Logins the pool queues.')
+    parser.add_argument('--timeout', type=float, default=0.5, help='authTimeout in seconds.')
+    parser.add_argument('--delay', type=float, default=None, help='Backend answers after this long instead of never.')
+    parser.add_argument('--json', action='store_true', help='Write the result as JSON.')
+    options = parser.parse_args()
+
+    pool = WorkerPool(options.workers, options.queue)
+    backend = StandInBackend(options.delay)
+    before = threading.active_count()
+    start = time.time()
+    outcomes = storm(pool, backend, options.logins, options.timeout)
+    elapsed = time.time() - start
+    left = threading.active_count() - before
+    if options.json:
+        print json.dumps({'logins': options.logins, 'workers': options.workers, 'seconds': elapsed,
+                          'threads_left': left, 'outcomes': outcomes})
+    else:
+        print '%d logins in %.2fs: %s' % (options.logins, elapsed,
+                                           ', '.join(['%d %s' % (outcomes[k], k) for k in sorted(outcomes)]))
+        print '%d threads left behind' % left
+    if left > options.workers:
+        print >> sys.stderr, 'More threads left than the %d workers' % options.workers
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+"""Memory footprint of idle sessions
+
+Creates many sessions on the in-memory harness, each negotiated and
+waiting at the prompt, and reports the growth of the process RSS
+per session.  With --threads, also starts a thread per session, blocked
+like the threaded backend's input thread, to show the cost of its stack
+at the threaded backend's THREAD_STACK_SIZE.
+
+Exits with status 1 if a session takes more than --max-bytes (by
+default MAX_BYTES, or MAX_BYTES_THREADS with --threads), so it guards
+against footprint regressions:
+
+    python benchmarks/footprint.py --sessions 10000 --max-bytes 9000
+    python benchmarks/footprint.py --threads --stack-size 65536
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import FakeHandler
+from loadgen import rss_kb
+from telnetsrv.threaded import start_thread
+
+# Client WILL TTYPE, its terminal type, and its window size
+NEGOTIATION = '\xff\xfb\x18\xff\xfa\x18\x00ansi\xff\xf0\xff\xfb\x1f\xff\xfa\x1f\x00\x50\x00\x18\xff\xf0'
+
+# Default limits in bytes per session, about 7.5kB and 27.5kB were measured
+MAX_BYTES = 9000
+MAX_BYTES_THREADS = 32768
+
+
+def idle_session():
+    '''Return a session that has negotiated and waits at the prompt.'''
+    handler = FakeHandler.create()
+    handler.cook(NEGOTIATION)
+    handler.sock.clear()
+    handler.cookedq = []
+    try:
+        # Runs out of input at the prompt.
+        handler.readline(prompt='> ')
+    except EOFError:
+        pass
+    return handler
+
+
+def measure(count, threads=False, stack_size=None):
+    '''Return the RSS growth in bytes per idle session.'''
+    idle_session()
+    gc.collect()
+    before = rss_kb()
+    sessions = [idle_session() for i in range(count)]
+    stop = threading.Event()
+    if threads:
+        for session in sessions:
+            start_thread(stop.wait, stack_size=stack_size)
+    gc.collect()
+    after = rss_kb()
+    stop.set()
+    return (after - before) * 1024.0 / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the memory used per idle session.')
+    parser.add_argument('-n', '--sessions', type=int, default=5000, help='Idle sessions to create.')
+    parser.add_argument('--threads', action='store_true', help='Start a thread per session too.')
+    parser.add_argument('--stack-size', type=int, default=None, help='Stack size of those threads in bytes.')
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help='Fail if a session takes more (default %d, %d with --threads).' % (
+                            MAX_BYTES, MAX_BYTES_THREADS))
+    parser.add_argument('--json', action='store_true', help='Write the result as JSON.')
+    options = parser.parse_args()
+    if rss_kb() is None:
+        parser.error('Needs /proc/self/status to measure the RSS')
+
+    per_session = measure(options.sessions, options.threads, options.stack_size)
+    if options.json:
+        print json.dumps({'sessions': options.sessions, 'threads': options.threads,
+                          'stack_size': options.stack_size, 'bytes_per_session': per_session})
+    else:
+        print '%.0f bytes per idle session' % per_session
+    max_bytes = options.max_bytes
+    if max_bytes is None:
+        max_bytes = options.threads and MAX_BYTES_THREADS or MAX_BYTES
+    if per_session > max_bytes:
+        print >> sys.stderr, 'More than the limit of %d bytes' % max_bytes
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
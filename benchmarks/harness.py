@@ -0,0 +1,143 @@
+"""In-memory transport for driving a handler without sockets or threads
+
+    FakeSocket  = Returns canned input from recv, records what is sent.
+    FakeHandler = A synchronous TelnetHandlerBase on a FakeSocket.  Its
+                  input cooker runs only when asked (cook), and readline
+                  raises EOFError once the cooked input is used up.
+
+    handler = FakeHandler.create(PAGER=False)
+    handler.cook('help\\r\\n')
+    line = handler.readline()
+    output = handler.sock.output()
+"""
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telnetsrv.telnetsrvlib import TelnetHandlerBase, SESSION_CLOSED
+
+
+class FakeSocket(object):
+    '''Socket stand-in.  Input is returned in chunks of at most chunk_size bytes.'''
+    def __init__(self, data='', chunk_size=None):
+        self.chunk_size = chunk_size
+        self.data = data
+        self.sent = []
+        self.send_calls = 0
+        self.recv_calls = 0
+
+    def feed(self, data):
+        '''Add to the input returned by recv.'''
+        self.data = self.data + data
+
+    def recv(self, size):
+        self.recv_calls += 1
+        if self.chunk_size:
+            size = min(size, self.chunk_size)
+        ret = self.data[:size]
+        self.data = self.data[size:]
+        return ret
+
+    def recv_into(self, buf, size=0):
+        data = self.recv(size or len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self.send_calls += 1
+        self.sent.append(str(data))
+
+    send = sendall
+
+    def output(self):
+        '''Return everything sent so far.'''
+        return ''.join(self.sent)
+
+    def clear(self):
+        '''Forget everything sent so far.'''
+        self.sent = []
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+    def fileno(self):
+        return -1
+
+
+class _Request(object):
+    pass
+
+
+class FakeHandler(TelnetHandlerBase):
+    '''A handler for benchmarks and experiments.  Nothing runs until asked.'''
+    BACKEND = 'fake'
+
+    def __init__(self, request, client_address, server):
+        self.cookedq = []
+        TelnetHandlerBase.__init__(self, request, client_address, server)
+
+    @classmethod
+    def create(cls, data='', chunk_size=None, **attrs):
+        '''Return a handler on a FakeSocket, after setup and with the class members in attrs overridden.'''
+        request = _Request()
+        request._sock = FakeSocket(data, chunk_size)
+        handler_class = cls
+        if attrs:
+            handler_class = types.ClassType(cls.__name__, (cls, ), attrs)
+        return handler_class(request, ('127.0.0.1', 0), None)
+
+    def handle(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def cook(self, data=''):
+        '''Run the input cooker over the data and any input not yet read.'''
+        if data:
+            self.sock.feed(data)
+        self.inputcooker()
+        self.eof = False
+
+    def connection_lost(self):
+        # The end of the canned input isn't the end of the session.
+        pass
+
+    def getc(self, block=True):
+        if not self.cookedq:
+            if not block:
+                return ''
+            raise EOFError
+        if self.cookedq[0] is SESSION_CLOSED:
+            raise EOFError
+        return self.cookedq.pop(0)
+
+    def inputcooker_socket_ready(self):
+        return bool(self.sock.data)
+
+    def inputcooker_store_queue(self, char):
+        if type(char) in [type(()), type([]), type("")]:
+            self.cookedq.extend(char)
+        else:
+            self.cookedq.append(char)
+
+    def run_blocking(self, timeout, func, *args):
+        return func(*args)
+
+    def sleep(self, seconds):
+        pass
+
+    def spawn(self, func, *args):
+        func(*args)
+
+    def current_task(self):
+        return None
+
+    def kill_task(self, task):
+        pass
@@ -0,0 +1,398 @@
+#!/usr/bin/python
+"""Load generator for the telnet server backends
+
+Starts a server in-process on the loopback interface and drives it with
+simulated telnet clients that negotiate options, log in, type commands
+one keystroke at a time and paste bulk input.  Reports, as JSON:
+
+    connections_per_sec   Connections that got through negotiation and
+                          login to the first prompt, then quit
+    commands_per_sec      Commands typed, run and answered with a new prompt
+    paste_lines_per_sec   Lines of pasted input run as commands
+    echo_latency_ms       p50 and p99 time for a typed key to be echoed
+    rss_per_idle_kb       Growth of the process RSS per idle logged in
+                          session (includes the client's socket)
+
+Each backend runs in its own process, as the green backends monkey patch
+the standard library.  For example:
+
+    python benchmarks/loadgen.py --clients 20 --output results.json
+    python benchmarks/loadgen.py --backend threaded --rate 5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Backend name -> telnetsrv module
+BACKENDS = {
+    'threaded': 'telnetsrv.threaded',
+    'green': 'telnetsrv.green',
+    'eventlet': 'telnetsrv.evtlet',
+}
+
+PROMPT = 'bench> '
+
+IAC = chr(255)
+DONT = chr(254)
+DO = chr(253)
+WONT = chr(252)
+WILL = chr(251)
+SB = chr(250)
+SE = chr(240)
+ECHO = chr(1)
+SGA = chr(3)
+TTYPE = chr(24)
+NAWS = chr(31)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def rss_kb():
+    '''Return the resident set size of this process in kB, or None if unknown.'''
+    try:
+        f = open('/proc/self/status')
+    except IOError:
+        return None
+    try:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    finally:
+        f.close()
+    return None
+
+
+def make_handler(TelnetHandler, command):
+    class BenchHandler(TelnetHandler):
+        PROMPT = PROMPT
+        WELCOME = 'Benchmark server'
+        authNeedUser = True
+        authNeedPass = True
+
+        def authCallback(self, username, password):
+            pass
+
+        @command('echo')
+        def command_echo(self, params):
+            '''<text>
+            Write the text back'''
+            self.writeresponse(' '.join(params))
+
+        @command('lines')
+        def command_lines(self, params):
+            '''<count>
+            Write many lines of output'''
+            for i in xrange(int(params[0])):
+                self.writeline('line %d of benchmark output' % i)
+
+    return BenchHandler
+
+
+def start_server(backend):
+    '''Start a server for the backend on a free loopback port.  Return the port.'''
+    if backend == 'green':
+        from gevent import monkey
+        monkey.patch_all()
+    elif backend == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    module = __import__(BACKENDS[backend], fromlist=['TelnetHandler'])
+    handler = make_handler(module.TelnetHandler, module.command)
+    if backend == 'green':
+        import gevent.server
+        server = gevent.server.StreamServer(('127.0.0.1', 0), handler.streamserver_handle)
+        server.start()
+        return server.server_port
+    if backend == 'eventlet':
+        import eventlet
+        listener = eventlet.listen(('127.0.0.1', 0))
+        eventlet.spawn(eventlet.serve, listener, handler.streamserver_handle)
+        return listener.getsockname()[1]
+    import SocketServer
+    import threading
+
+    class Server(SocketServer.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+        request_queue_size = 128
+
+    server = Server(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server.server_address[1]
+
+
+class Client(object):
+    '''A simulated telnet client.'''
+    def __init__(self, port, timeout=30):
+        import socket
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout)
+        self.text = ''
+        self.raw = ''
+        self.latencies = []
+
+    def _negotiate(self, cmd, opt):
+        # Answer every request, the server mustn't loop.
+        if cmd == WILL:
+            self.sock.sendall(IAC + (opt in (ECHO, SGA) and DO or DONT) + opt)
+        elif cmd == DO:
+            if opt in (NAWS, TTYPE):
+                self.sock.sendall(IAC + WILL + opt)
+                if opt == NAWS:
+                    self.sock.sendall(IAC + SB + NAWS + '\x00\x50\x00\x18' + IAC + SE)
+            else:
+                self.sock.sendall(IAC + WONT + opt)
+
+    def _subnegotiation(self, data):
+        if data[:2] == TTYPE + chr(1):
+            self.sock.sendall(IAC + SB + TTYPE + chr(0) + 'ansi' + IAC + SE)
+
+    def receive(self):
+        '''Read what's available, answering negotiation, keeping the text.'''
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError
+        raw = self.raw + data
+        text = []
+        pos = 0
+        while True:
+            idx = raw.find(IAC, pos)
+            if idx < 0:
+                text.append(raw[pos:])
+                raw = ''
+                break
+            text.append(raw[pos:idx])
+            if idx + 1 >= len(raw):
+                raw = raw[idx:]
+                break
+            cmd = raw[idx + 1]
+            if cmd == IAC:
+                text.append(IAC)
+                pos = idx + 2
+            elif cmd in (WILL, WONT, DO, DONT):
+                if idx + 2 >= len(raw):
+                    raw = raw[idx:]
+                    break
+                self._negotiate(cmd, raw[idx + 2])
+                pos = idx + 3
+            elif cmd == SB:
+                end = raw.find(IAC + SE, idx)
+                if end < 0:
+                    raw = raw[idx:]
+                    break
+                self._subnegotiation(raw[idx + 2:end])
+                pos = end + 2
+            else:
+                pos = idx + 2
+        self.raw = raw
+        self.text = self.text + ''.join(text)
+
+    def expect(self, text, count=1):
+        '''Read until text was received count times, then forget what was received.'''
+        while self.text.count(text) < count:
+            self.receive()
+        self.text = ''
+
+    def login(self):
+        self.expect('Username: ')
+        self.sock.sendall('bench\r\n')
+        self.expect('Password: ')
+        self.sock.sendall('secret\r\n')
+        self.expect(PROMPT)
+
+    def type(self, line):
+        '''Type a command a key at a time, timing the echo of each key.'''
+        import time
+        for char in line:
+            start = time.time()
+            self.sock.sendall(char)
+            while char not in self.text:
+                self.receive()
+            self.latencies.append(time.time() - start)
+            self.text = ''
+        self.sock.sendall('\r\n')
+        self.expect(PROMPT)
+
+    def paste(self, lines):
+        '''Send many command lines at once, wait for all of them to run.'''
+        self.sock.sendall(''.join([line + '\r\n' for line in lines]))
+        self.expect(PROMPT, len(lines))
+
+    def close(self):
+        try:
+            self.sock.sendall('quit\r\n')
+            self.expect('Goodbye')
+        except (EOFError, IOError):
+            pass
+        self.sock.close()
+
+
+def run_clients(count, func):
+    '''Run func(number) in count concurrent threads, return the elapsed seconds.'''
+    import threading
+    import time
+    errors = []
+
+    def run(number):
+        try:
+            func(number)
+        except Exception, e:
+            errors.append('%s: %s' % (e.__class__.__name__, e))
+
+    threads = [threading.Thread(target=run, args=(i, )) for i in range(count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError('%d clients failed, first: %s' % (len(errors), errors[0]))
+    return time.time() - start
+
+
+def run_backend(backend, options):
+    '''Benchmark one backend in this process, return the results dictionary.'''
+    import platform
+    import time
+    port = start_server(backend)
+    result = {
+        'backend': backend,
+        'python': platform.python_version(),
+        'clients': options.clients,
+    }
+
+    # Connection rate: connect, negotiate, log in and quit.
+    per_client = max(1, options.connections // options.clients)
+
+    def connect(number):
+        for i in range(per_client):
+            client = Client(port)
+            client.login()
+            client.close()
+    elapsed = run_clients(options.clients, connect)
+    result['connections_per_sec'] = per_client * options.clients / elapsed
+
+    # Command rate and echo latency.
+    clients = [Client(port) for i in range(options.clients)]
+    for client in clients:
+        client.login()
+    line = 'echo ' + 'x' * max(0, options.line_length - 5)
+
+    def commands(number):
+        client = clients[number]
+        for i in range(options.commands):
+            started = time.time()
+            client.type(line)
+            if options.rate:
+                time.sleep(max(0, 1.0 / options.rate - (time.time() - started)))
+    elapsed = run_clients(options.clients, commands)
+    result['commands_per_sec'] = options.commands * options.clients / elapsed
+    latencies = []
+    for client in clients:
+        latencies.extend(client.latencies)
+    result['echo_latency_ms'] = {
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+    }
+
+    # Bulk paste.
+    def paste(number):
+        clients[number].paste(['echo pasted line %d' % i for i in range(options.paste)])
+    elapsed = run_clients(options.clients, paste)
+    result['paste_lines_per_sec'] = options.paste * options.clients / elapsed
+    for client in clients:
+        client.close()
+
+    # Memory held by idle sessions.
+    time.sleep(1)
+    before = rss_kb()
+    idle = [Client(port) for i in range(options.idle)]
+    for client in idle:
+        client.login()
+    time.sleep(1)
+    after = rss_kb()
+    if before is not None and after is not None and options.idle:
+        result['rss_per_idle_kb'] = float(after - before) / options.idle
+    else:
+        result['rss_per_idle_kb'] = None
+    for client in idle:
+        client.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the telnet server backends.')
+    parser.add_argument('-b', '--backend', action='append', choices=sorted(BACKENDS),
+                        help='Backend to benchmark, may be repeated.  Default: all of them.')
+    parser.add_argument('-c', '--clients', type=int, default=10, help='Concurrent clients.')
+    parser.add_argument('--connections', type=int, default=50, help='Connections to open for the connection rate.')
+    parser.add_argument('--commands', type=int, default=20, help='Commands each client types.')
+    parser.add_argument('--rate', type=float, default=0, help='Commands per second per client, 0 for as fast as possible.')
+    parser.add_argument('--line-length', type=int, default=20, help='Length of each typed command line.')
+    parser.add_argument('--paste', type=int, default=200, help='Lines each client pastes at once.')
+    parser.add_argument('--idle', type=int, default=100, help='Idle sessions to open for the memory measurement.')
+    parser.add_argument('-o', '--output', help='Write the JSON results to this file instead of stdout.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        # Run one backend, report to the parent on stdout.
+        try:
+            result = run_backend(options.backend[0], options)
+        except ImportError, e:
+            result = {'backend': options.backend[0], 'error': 'not available: %s' % e}
+        except Exception, e:
+            result = {'backend': options.backend[0], 'error': '%s: %s' % (e.__class__.__name__, e)}
+        sys.stdout.write(json.dumps(result))
+        sys.stdout.flush()
+        # Don't wait for lingering sessions.
+        os._exit(0)
+
+    results = []
+    for backend in options.backend or sorted(BACKENDS):
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child'] +
+                                 strip_backends(sys.argv[1:]) + ['--backend', backend],
+                                 stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        try:
+            results.append(json.loads(output))
+        except ValueError:
+            results.append({'backend': backend, 'error': 'exit status %s' % child.returncode})
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(text + '\n')
+        finally:
+            f.close()
+    else:
+        print text
+
+
+def strip_backends(args):
+    '''Remove the --backend and --output arguments for a child's command line.'''
+    stripped = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in ('-b', '--backend', '-o', '--output'):
+            skip = True
+        elif not arg.startswith('--backend=') and not arg.startswith('--output='):
+            stripped.append(arg)
+    return stripped
+
+
+if __name__ == '__main__':
+    main()
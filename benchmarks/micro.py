@@ -0,0 +1,243 @@
+#!/usr/bin/python
+"""Microbenchmarks of the input cooker, line editor, tokenizer, history and output path
+
+Each benchmark is a function that does its setup and returns a callable
+running one iteration, so it can be timed by any timeit or pyperf style
+runner:
+
+    import timeit, micro
+    timeit.timeit(micro.cook_paste(), number=10)
+
+Run directly to time all of them, or those named:
+
+    python benchmarks/micro.py
+    python benchmarks/micro.py cook_iac readline_edit --repeat 5 --json
+"""
+
+import argparse
+import atexit
+import curses
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import FakeHandler
+from telnetsrv.telnetsrvlib import InputBashLike, IAC, SB, SE, NOP, NAWS, WILL, ECHO
+from telnetsrv.history import HistoryStore
+
+
+def _cook(data, **attrs):
+    handler = FakeHandler.create(**attrs)
+    handler.sock.clear()
+
+    def run():
+        handler.cookedq = []
+        handler.cook(data)
+    return run
+
+
+def cook_paste():
+    '''Input cooker: 64kB of pasted command lines.'''
+    return _cook('show interface ethernet0 counters | include error\r\n' * 1300)
+
+
+def cook_iac():
+    '''Input cooker: text full of escaped 0xff bytes, NOPs and window size changes.'''
+    chunk = ('abc' + IAC + IAC + 'def' + IAC + NOP +
+             IAC + SB + NAWS + '\x00\x50\x00\x18' + IAC + SE + IAC + WILL + ECHO)
+    return _cook(chunk * 1000)
+
+
+def cook_escapes():
+    '''Input cooker: typing dominated by cursor and editing key sequences.'''
+    handler = FakeHandler.create()
+    keys = dict([(code, seq) for (seq, code) in handler.ESCSEQ.items()])
+    sequence = ''.join([keys.get(code, '') for code in
+                        (curses.KEY_LEFT, curses.KEY_RIGHT, curses.KEY_UP, curses.KEY_DOWN,
+                         curses.KEY_HOME, curses.KEY_END, curses.KEY_DC)])
+    return _cook(('ab' + sequence) * 500)
+
+
+def _readline(keys, **attrs):
+    handler = FakeHandler.create(**attrs)
+
+    def run():
+        handler.sock.clear()
+        handler.cookedq = list(keys)
+        handler.readline(prompt='bench> ')
+    return run
+
+
+def readline_typing():
+    '''Line editor: typing a command line with echo.'''
+    return _readline('show interface ethernet0 counters detail\n')
+
+
+def readline_edit():
+    '''Line editor: editing the middle of a 2000 character line.'''
+    keys = ['x'] * 2000 + [curses.KEY_LEFT] * 1000
+    for i in range(200):
+        keys.extend(['y', curses.KEY_LEFT, chr(127)])
+    keys.append('\n')
+    return _readline(keys)
+
+
+def readline_history():
+    '''Line editor: scrolling back through a full history.'''
+    handler = FakeHandler.create()
+    for i in range(500):
+        handler.history.append('command number %d' % i)
+    keys = [curses.KEY_UP] * 500 + ['\n']
+
+    def run():
+        handler.sock.clear()
+        handler.cookedq = list(keys)
+        # Adds the line to the history, which stays at its maximum length.
+        handler.readline(prompt='bench> ')
+    return run
+
+
+def history_load():
+    '''History: loading a saved history of 500 lines, with escapes and newlines.'''
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    store = HistoryStore(directory)
+    history = store.load('bench')
+    lines = []
+    for i in range(500):
+        lines.append(['show counters %d' % i, 'echo a\\nb\\\\ %d' % i, 'paste\nof %d\\' % i][i % 3])
+        history.append(lines[-1])
+    history.flush()
+    loaded = list(store.load('bench'))
+    if loaded != lines:
+        # Every line must come back as it was saved.
+        raise RuntimeError('History changed by saving and loading: %r' % (
+            [(a, b) for (a, b) in zip(lines, loaded) if a != b][:3], ))
+
+    def run():
+        store.load('bench')
+    return run
+
+
+def tokenize():
+    '''Tokenizer: InputBashLike on lines with quotes, escapes and pipes.'''
+    handler = FakeHandler.create()
+    lines = [
+        'show interface ethernet0 counters',
+        'set description "uplink to core\\tswitch" \'and more\' plain\\ escaped',
+        'show log | include "error|warn" | head 20 &',
+        ' '.join(['word%d' % i for i in range(200)]),
+    ]
+
+    def run():
+        for line in lines:
+            InputBashLike(handler, line)
+    return run
+
+
+def tokenize_escapes():
+    '''Tokenizer: InputBashLike on 200 arguments with escapes and quotes glued to text.'''
+    handler = FakeHandler.create()
+    lines = [
+        'set ' + ' '.join(['"quo\\"ted" \'a b\'x'] * 100),
+        'set ' + ' '.join(['a\\ b\\tc\\"d'] * 200),
+    ]
+
+    def run():
+        for line in lines:
+            InputBashLike(handler, line)
+    return run
+
+
+def write_lines():
+    '''Output path: writeline of 5000 lines, no pager.'''
+    handler = FakeHandler.create(PAGER=False)
+    lines = ['line %d of output, about as long as a typical show command line' % i for i in range(5000)]
+
+    def run():
+        handler.sock.clear()
+        for line in lines:
+            handler.writeline(line)
+    return run
+
+
+def write_block():
+    '''Output path: one 1MB write with newlines and 0xff bytes to escape.'''
+    handler = FakeHandler.create()
+    text = ('x' * 60 + IAC + '\n') * 16000
+
+    def run():
+        handler.sock.clear()
+        handler.write(text)
+    return run
+
+
+def write_paged():
+    '''Output path: writeline through the pager of a 5000 line window.'''
+    handler = FakeHandler.create()
+    handler.setwindowsize(80, 5001)
+    lines = ['line %d of paged output' % i for i in range(5000)]
+
+    def run():
+        handler.sock.clear()
+        handler.pager_rows = 0
+        for line in lines:
+            handler.writeline(line)
+        handler.pager_rows = None
+    return run
+
+
+BENCHMARKS = [
+    cook_paste,
+    cook_iac,
+    cook_escapes,
+    readline_typing,
+    readline_edit,
+    readline_history,
+    history_load,
+    tokenize,
+    tokenize_escapes,
+    write_lines,
+    write_block,
+    write_paged,
+]
+
+
+def main():
+    names = [bench.__name__ for bench in BENCHMARKS]
+    parser = argparse.ArgumentParser(description='Run the telnetsrv microbenchmarks.')
+    parser.add_argument('names', nargs='*', metavar='NAME', help='Benchmarks to run: %s' % ', '.join(names))
+    parser.add_argument('-n', '--number', type=int, default=0, help='Iterations per timing, 0 to choose automatically.')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timings to take, the best is reported.')
+    parser.add_argument('--json', action='store_true', help='Write the results as JSON.')
+    options = parser.parse_args()
+    for name in options.names:
+        if name not in names:
+            parser.error('Unknown benchmark %s' % name)
+
+    results = {}
+    for bench in BENCHMARKS:
+        if options.names and bench.__name__ not in options.names:
+            continue
+        run = bench()
+        number = options.number
+        if not number:
+            # Aim for about 0.2 seconds per timing.
+            number = 1
+            while timeit.timeit(run, number=number) < 0.2 and number < 1000000:
+                number = number * 10
+        best = min(timeit.repeat(run, number=number, repeat=options.repeat)) / number
+        results[bench.__name__] = best
+        if not options.json:
+            print '%-18s %10.3f ms   %s' % (bench.__name__, best * 1000, bench.__doc__)
+    if options.json:
+        print json.dumps({'unit': 'seconds', 'results': results}, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
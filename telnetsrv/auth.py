@@ -0,0 +1,207 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""Authentication helpers shared by the telnet and SSH handlers.
+
+    AuthCache    = Remembers successful logins for a limited time so a
+                   slow authentication backend is only consulted once
+                   per TTL for the same credentials.
+    AuthThrottle = Counts failed logins per source address and refuses
+                   to call the authentication backend for addresses
+                   that fail too often.
+    WorkerPool   = A fixed number of threads that run authentication
+                   callbacks with a timeout.  default_pool is used by
+                   authTimeout on the threaded backend and SSH.
+
+Create one instance of each and set it as a class member of the handler
+so that it is shared by every session.
+"""
+
+import hashlib
+import hmac
+import os
+import Queue
+import sys
+import threading
+import time
+
+
+class AuthTimeout(Exception):
+    '''Raised when an authentication callback takes too long.'''
+    pass
+
+
+class AuthBusy(AuthTimeout):
+    '''Raised when every authentication worker is busy and the queue is full.'''
+    pass
+
+
+class WorkerPool(object):
+    '''A fixed number of worker threads running calls from a bounded queue.
+    A backend that hangs can only pin these workers; once they and the
+    queue are taken, further calls fail at once instead of starting threads.'''
+    def __init__(self, workers=8, max_queued=32):
+        self.workers = workers
+        self._queue = Queue.Queue(max_queued)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            (func, args, result, done) = self._queue.get()
+            if 'abandoned' in result:
+                # The caller has stopped waiting, don't consult the backend for nothing.
+                continue
+            try:
+                result['value'] = func(*args)
+            except:
+                result['error'] = sys.exc_info()
+            done.set()
+
+    def call(self, timeout, func, *args):
+        '''Run func(*args) on a worker and wait at most timeout seconds.
+        Re-raises any exception thrown by func, raises AuthBusy if the
+        queue is full and AuthTimeout if it does not complete in time.
+        A call that times out keeps its worker until it returns.'''
+        if len(self._threads) < self.workers:
+            self._start()
+        result = {}
+        done = threading.Event()
+        try:
+            self._queue.put_nowait((func, args, result, done))
+        except Queue.Full:
+            raise AuthBusy('All %d authentication workers are busy' % (self.workers, ))
+        if not done.wait(timeout):
+            result['abandoned'] = True
+            raise AuthTimeout('Authentication did not complete in %s seconds' % (timeout, ))
+        if 'error' in result:
+            exc_type, exc_value, exc_tb = result['error']
+            raise exc_type, exc_value, exc_tb
+        return result.get('value')
+
+
+# Runs the callbacks of every handler using authTimeout on the threaded
+# backend and SSH.  Replace it with a larger WorkerPool before serving to
+# allow more slow logins at once.
+default_pool = WorkerPool()
+
+
+def call_with_timeout(timeout, func, *args):
+    '''Run func(*args) on the default_pool and wait at most timeout seconds.'''
+    return default_pool.call(timeout, func, *args)
+
+
+class AuthCache(object):
+    '''Time limited cache of successful authentications.
+    Credentials are never stored, only a keyed hash of them.'''
+    def __init__(self, ttl=300, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._secret = os.urandom(32)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _key(self, credentials):
+        data = '\0'.join([repr(c) for c in credentials])
+        return hmac.new(self._secret, data, hashlib.sha256).digest()
+
+    def check(self, *credentials):
+        '''Return True if these credentials succeeded within the last ttl seconds.'''
+        key = self._key(credentials)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            expires = self._entries.get(key)
+            if expires is None:
+                return False
+            if expires < now:
+                del self._entries[key]
+                return False
+            return True
+        finally:
+            self._lock.release()
+
+    def store(self, *credentials):
+        '''Remember that these credentials succeeded.'''
+        key = self._key(credentials)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if len(self._entries) >= self.maxsize:
+                # Drop anything expired, then the entries closest to expiry.
+                for k, expires in self._entries.items():
+                    if expires < now:
+                        del self._entries[k]
+                if len(self._entries) >= self.maxsize:
+                    oldest = sorted(self._entries.items(), key=lambda item: item[1])
+                    for k, expires in oldest[:len(self._entries) - self.maxsize + 1]:
+                        del self._entries[k]
+            self._entries[key] = now + self.ttl
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        '''Forget all cached authentications.'''
+        self._lock.acquire()
+        self._entries = {}
+        self._lock.release()
+
+
+class AuthThrottle(object):
+    '''Per source address failed login throttling.
+    After max_failures failures within window seconds, an address is
+    locked out for lockout seconds.'''
+    def __init__(self, max_failures=5, window=60, lockout=300):
+        self.max_failures = max_failures
+        self.window = window
+        self.lockout = lockout
+        # address -> [failure count, window start, locked until]
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def blocked(self, address):
+        '''Return True if this address may not attempt authentication now.'''
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._failures.get(address)
+            if entry is None:
+                return False
+            if entry[2] > now:
+                return True
+            if entry[2] or entry[1] + self.window < now:
+                # Lockout or counting window is over, start afresh.
+                del self._failures[address]
+            return False
+        finally:
+            self._lock.release()
+
+    def failure(self, address):
+        '''Record a failed authentication from this address.'''
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._failures.get(address)
+            if entry is None or (entry[2] or entry[1] + self.window) < now:
+                entry = self._failures[address] = [0, now, 0]
+            entry[0] += 1
+            if entry[0] >= self.max_failures:
+                entry[2] = now + self.lockout
+        finally:
+            self._lock.release()
+
+    def success(self, address):
+        '''Record a successful authentication, clearing any failures.'''
+        self._lock.acquire()
+        self._failures.pop(address, None)
+        self._lock.release()
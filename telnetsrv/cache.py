@@ -0,0 +1,108 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""Command result cache
+
+Commands defined with @command(..., cache=seconds) have their output
+kept in a ResultCache shared by every session of the handler class.
+The same command with the same parameters is only run once per TTL,
+however many sessions ask for it.  While it runs, other sessions asking
+for the same result wait for it instead of running it again.
+"""
+
+import collections
+import threading
+import time
+
+
+class _Pending(object):
+    '''A result being computed.'''
+    def __init__(self):
+        self.done = False
+        self.failed = False
+        self.value = None
+
+
+class ResultCache(object):
+    '''Thread safe LRU cache of results with a time to live, holding at most maxsize results.'''
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        # key -> (expires, value), least recently used first
+        self._entries = collections.OrderedDict()
+        # key -> _Pending, for results being computed
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+
+    def get(self, key, ttl, compute, wait=time.sleep):
+        '''Return the cached value for key, calling compute() to get it if needed.
+        Callers for a key that is already being computed call wait(seconds)
+        until it is ready.  Exceptions from compute are not cached.'''
+        while True:
+            now = time.time()
+            self._lock.acquire()
+            try:
+                entry = self._entries.pop(key, None)
+                if entry is not None and entry[0] > now:
+                    # Still fresh, make it the most recently used.
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return entry[1]
+                pending = self._pending.get(key)
+                leader = pending is None
+                if leader:
+                    pending = self._pending[key] = _Pending()
+                    self.misses += 1
+                else:
+                    self.collapsed += 1
+            finally:
+                self._lock.release()
+            if leader:
+                return self._compute(key, ttl, compute, pending)
+            while not pending.done:
+                wait(0.01)
+            if not pending.failed:
+                return pending.value
+            # The computation failed, have another go.
+
+    def _compute(self, key, ttl, compute, pending):
+        try:
+            value = compute()
+        except:
+            self._lock.acquire()
+            del self._pending[key]
+            self._lock.release()
+            pending.failed = True
+            pending.done = True
+            raise
+        self._lock.acquire()
+        try:
+            del self._pending[key]
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+        pending.value = value
+        pending.done = True
+        return value
+
+    def clear(self):
+        '''Forget all cached results.'''
+        self._lock.acquire()
+        self._entries.clear()
+        self._lock.release()
+
+    def stats(self):
+        '''Return a dictionary of cache statistics.'''
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'collapsed': self.collapsed,
+            'evictions': self.evictions,
+        }
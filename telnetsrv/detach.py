@@ -0,0 +1,157 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""Detachable sessions
+
+When the connection of a logged in user drops, the session can be kept
+running instead of ended.  Its output is kept in a bounded ring buffer
+until the same user connects again, when the buffered output is replayed
+and the session continues on the new connection.
+
+    OutputBuffer     = The ring buffer holding a detached session's output.
+    DetachedSessions = Create one and set it as the handler's
+                       detached_sessions class member to enable
+                       detaching.  Holds the detached sessions of every
+                       user and enforces the server wide memory limit.
+"""
+
+import collections
+import threading
+
+
+class OutputBuffer(object):
+    '''The most recent output of a detached session.'''
+    def __init__(self, owner):
+        self.owner = owner
+        self.chunks = collections.deque()
+        self.size = 0
+        self.dropped = 0
+        self.closed = False
+
+    def write(self, text):
+        '''Keep the text.  Return False if the buffer is closed, and the text should be sent.'''
+        return self.owner._write(self, text)
+
+    def drain(self):
+        '''Return and forget everything buffered, close the buffer once empty.'''
+        return self.owner._drain(self)
+
+    def _trim(self, size):
+        '''Drop the oldest output until at most size bytes are held.  Return the bytes freed.'''
+        freed = 0
+        while self.size > size:
+            chunk = self.chunks[0]
+            excess = self.size - size
+            if len(chunk) > excess:
+                # Don't leave part of a line behind.
+                cut = chunk.find('\n', excess - 1) + 1 or len(chunk)
+                self.chunks[0] = chunk[cut:]
+                if not self.chunks[0]:
+                    self.chunks.popleft()
+            else:
+                self.chunks.popleft()
+                cut = len(chunk)
+            self.size -= cut
+            self.dropped += cut
+            freed += cut
+        return freed
+
+
+class DetachedSessions(object):
+    '''Server wide registry of detached sessions.
+
+    buffer_size is the most output kept for one session, max_buffered the
+    most kept for all sessions together.  A session not reattached within
+    timeout seconds is ended.'''
+    def __init__(self, buffer_size=65536, max_buffered=4194304, timeout=600):
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.timeout = timeout
+        # username -> list of detached handlers, most recent last
+        self._sessions = {}
+        self._buffered = 0
+        self._lock = threading.Lock()
+
+    def detach(self, handler):
+        '''Keep the handler's session for a later reattach.  Return its OutputBuffer.'''
+        self._lock.acquire()
+        try:
+            buffer = OutputBuffer(self)
+            self._sessions.setdefault(handler.username, []).append(handler)
+            return buffer
+        finally:
+            self._lock.release()
+
+    def claim(self, username):
+        '''Remove and return the user's most recently detached session, or None.'''
+        self._lock.acquire()
+        try:
+            sessions = self._sessions.get(username)
+            if not sessions:
+                return None
+            handler = sessions.pop()
+            if not sessions:
+                del self._sessions[username]
+            return handler
+        finally:
+            self._lock.release()
+
+    def discard(self, handler):
+        '''Forget a detached session, returning True if it was waiting for a reattach.'''
+        self._lock.acquire()
+        try:
+            sessions = self._sessions.get(handler.username, [])
+            if handler not in sessions:
+                return False
+            sessions.remove(handler)
+            if not sessions:
+                del self._sessions[handler.username]
+            buffer = handler.output_buffer
+            if buffer is not None:
+                self._buffered -= buffer._trim(0)
+                buffer.closed = True
+            return True
+        finally:
+            self._lock.release()
+
+    def sessions(self, username):
+        '''Return the number of detached sessions for this user.'''
+        self._lock.acquire()
+        try:
+            return len(self._sessions.get(username, []))
+        finally:
+            self._lock.release()
+
+    def buffered(self):
+        '''Return the number of output bytes held for all detached sessions.'''
+        return self._buffered
+
+    def _write(self, buffer, text):
+        self._lock.acquire()
+        try:
+            if buffer.closed:
+                return False
+            buffer.chunks.append(text)
+            buffer.size += len(text)
+            self._buffered += len(text)
+            # The writer pays for going over either limit.
+            limit = min(self.buffer_size, self.max_buffered - (self._buffered - buffer.size))
+            self._buffered -= buffer._trim(max(limit, 0))
+            return True
+        finally:
+            self._lock.release()
+
+    def _drain(self, buffer):
+        self._lock.acquire()
+        try:
+            text = ''.join(buffer.chunks)
+            if buffer.dropped:
+                text = '\r\n[%d bytes of output lost]\r\n' % buffer.dropped + text
+            buffer.chunks.clear()
+            self._buffered -= buffer.size
+            buffer.size = 0
+            buffer.dropped = 0
+            if not text:
+                buffer.closed = True
+            return text
+        finally:
+            self._lock.release()
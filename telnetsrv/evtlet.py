@@ -2,11 +2,14 @@
 # Telnet handler concrete class using green threads with eventlet
 
 import eventlet
+import eventlet.tpool
+import eventlet.green.ssl
 
-from telnetsrvlib import TelnetHandlerBase, command
+from telnetsrvlib import TelnetHandlerBase, command, SESSION_CLOSED
 
 class TelnetHandler(TelnetHandlerBase):
     "A telnet server handler using Gevent"
+    BACKEND = "eventlet"
     def __init__(self, request, client_address, server):
         # Create a green queue for input handling
         self.cookedq = eventlet.queue.Queue()
@@ -35,9 +38,18 @@ class TelnetHandler(TelnetHandlerBase):
     def getc(self, block=True):
         """Return one character from the input queue"""
         try:
-            return self.cookedq.get(block)
+            ret = self.cookedq.get(block)
         except eventlet.queue.Empty:
             return ''
+        if ret is SESSION_CLOSED:
+            # Leave it for any later call.
+            self.cookedq.put(ret)
+            raise EOFError
+        return ret
+
+    def wait_readable(self, fileno, timeout):
+        """Wait at most timeout seconds for the file descriptor to be readable"""
+        return eventlet.select.select([fileno], [], [], timeout)[0] != []
 
     def inputcooker_socket_ready(self):
         """Indicate that the socket is ready to be read"""
@@ -56,3 +68,30 @@ class TelnetHandler(TelnetHandlerBase):
         else:
             self.cookedq.put(char)
 
+    # -- Green helper functions --
+
+    def run_blocking(self, timeout, func, *args):
+        """Call func(*args) in the thread pool, wait at most timeout seconds"""
+        with eventlet.Timeout(timeout):
+            return eventlet.tpool.execute(func, *args)
+
+    def sleep(self, seconds):
+        """Pause this greenlet"""
+        eventlet.sleep(seconds)
+
+    def spawn(self, func, *args):
+        """Run func(*args) in a new greenthread"""
+        return eventlet.spawn(func, *args)
+
+    def current_task(self):
+        """Return the running greenthread"""
+        return eventlet.greenthread.getcurrent()
+
+    def kill_task(self, task):
+        """Kill the greenthread"""
+        task.kill()
+
+    def tls_wrap(self, sock):
+        """Return the socket wrapped with tls_context, after the handshake"""
+        return self.tls_handshake(eventlet.green.ssl.GreenSSLSocket(
+            sock, server_side=True, do_handshake_on_connect=False, _context=self.tls_context))
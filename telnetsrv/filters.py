@@ -0,0 +1,152 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""Output filters for command pipelines
+
+A command line may end with a pipeline, for example:
+
+    show log | include error | head 20
+
+Each line the command writes is passed through the filters in order
+before it reaches the client.  Filters only ever hold a bounded amount
+of output.  When a filter wants no more input (head), the command is
+stopped by raising OutputAborted from its next write.
+"""
+
+import collections
+import re
+
+
+class OutputAborted(Exception):
+    '''Raised from a write when the command's output is no longer wanted.'''
+    pass
+
+
+class OutputFilter(object):
+    '''Base output filter.  Created with the list of parameters following its name.'''
+    # Set when the filter will not pass on any more lines.
+    exhausted = False
+
+    def __init__(self, params):
+        self.params = params
+
+    def feed(self, line):
+        '''Return the list of lines to pass on for this input line.'''
+        return [line]
+
+    def finish(self):
+        '''Return the list of lines to pass on after the last input line.'''
+        return []
+
+
+class Include(OutputFilter):
+    '''<regex>
+    Only show lines matching the regular expression'''
+    def __init__(self, params):
+        OutputFilter.__init__(self, params)
+        if not params:
+            raise ValueError('Missing regular expression')
+        try:
+            self.regex = re.compile(' '.join(params))
+        except re.error, e:
+            raise ValueError('Bad regular expression: %s' % e)
+
+    def feed(self, line):
+        if self.regex.search(line):
+            return [line]
+        return []
+
+
+class Exclude(Include):
+    '''<regex>
+    Hide lines matching the regular expression'''
+    def feed(self, line):
+        if self.regex.search(line):
+            return []
+        return [line]
+
+
+class Count(OutputFilter):
+    '''
+    Only show the number of lines'''
+    def __init__(self, params):
+        OutputFilter.__init__(self, params)
+        self.count = 0
+
+    def feed(self, line):
+        self.count += 1
+        return []
+
+    def finish(self):
+        return ['Count: %d lines' % self.count]
+
+
+class Head(OutputFilter):
+    '''[<lines>]
+    Only show the first lines, then stop the command'''
+    default_lines = 10
+
+    def __init__(self, params):
+        OutputFilter.__init__(self, params)
+        try:
+            self.lines = int(params[0]) if params else self.default_lines
+        except ValueError:
+            raise ValueError('Line count must be a number')
+        self.exhausted = self.lines <= 0
+
+    def feed(self, line):
+        if self.exhausted:
+            return []
+        self.lines -= 1
+        self.exhausted = self.lines <= 0
+        return [line]
+
+
+class Tail(Head):
+    '''[<lines>]
+    Only show the last lines'''
+    def __init__(self, params):
+        Head.__init__(self, params)
+        self.exhausted = False
+        self.buffer = collections.deque(maxlen=max(self.lines, 0))
+
+    def feed(self, line):
+        self.buffer.append(line)
+        return []
+
+    def finish(self):
+        return list(self.buffer)
+
+
+class FilterChain(object):
+    '''A pipeline of output filters.'''
+    def __init__(self, filters):
+        self.filters = filters
+
+    @property
+    def exhausted(self):
+        '''True if the command's further output would be discarded.'''
+        for f in self.filters:
+            if f.exhausted:
+                return True
+        return False
+
+    def _run(self, lines, start):
+        for f in self.filters[start:]:
+            result = []
+            for line in lines:
+                result.extend(f.feed(line))
+            lines = result
+            if not lines:
+                break
+        return lines
+
+    def feed(self, line):
+        '''Return the lines to write for this line of command output.'''
+        return self._run([line], 0)
+
+    def finish(self):
+        '''Return the lines to write once the command is done.'''
+        lines = []
+        for idx, f in enumerate(self.filters):
+            lines.extend(self._run(f.finish(), idx + 1))
+        return lines
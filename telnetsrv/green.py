@@ -1,12 +1,13 @@
 #!/usr/bin/python
 # Telnet handler concrete class using green threads
 
-import gevent, gevent.queue
+import gevent, gevent.queue, gevent.ssl
 
-from telnetsrvlib import TelnetHandlerBase, command
+from telnetsrvlib import TelnetHandlerBase, command, SESSION_CLOSED
 
 class TelnetHandler(TelnetHandlerBase):
     "A telnet server handler using Gevent"
+    BACKEND = "gevent"
     def __init__(self, request, client_address, server):
         # Create a green queue for input handling
         self.cookedq = gevent.queue.Queue()
@@ -35,9 +36,18 @@ class TelnetHandler(TelnetHandlerBase):
     def getc(self, block=True):
         """Return one character from the input queue"""
         try:
-            return self.cookedq.get(block)
+            ret = self.cookedq.get(block)
         except gevent.queue.Empty:
             return ''
+        if ret is SESSION_CLOSED:
+            # Leave it for any later call.
+            self.cookedq.put(ret)
+            raise EOFError
+        return ret
+
+    def wait_readable(self, fileno, timeout):
+        """Wait at most timeout seconds for the file descriptor to be readable"""
+        return gevent.select.select([fileno], [], [], timeout)[0] != []
 
     def inputcooker_socket_ready(self):
         """Indicate that the socket is ready to be read"""
@@ -51,3 +61,29 @@ class TelnetHandler(TelnetHandlerBase):
         else:
             self.cookedq.put(char)
 
+    # -- Green helper functions --
+
+    def run_blocking(self, timeout, func, *args):
+        """Call func(*args) in the hub's thread pool, wait at most timeout seconds"""
+        return gevent.get_hub().threadpool.spawn(func, *args).get(timeout=timeout)
+
+    def sleep(self, seconds):
+        """Pause this greenlet"""
+        gevent.sleep(seconds)
+
+    def spawn(self, func, *args):
+        """Run func(*args) in a new greenlet"""
+        return gevent.spawn(func, *args)
+
+    def current_task(self):
+        """Return the running greenlet"""
+        return gevent.getcurrent()
+
+    def kill_task(self, task):
+        """Kill the greenlet"""
+        task.kill(block=False)
+
+    def tls_wrap(self, sock):
+        """Return the socket wrapped with tls_context, after the handshake"""
+        return self.tls_handshake(gevent.ssl.SSLSocket(
+            sock, server_side=True, do_handshake_on_connect=False, _context=self.tls_context))
@@ -0,0 +1,215 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""Command history
+
+    History      = A bounded list of recent command lines, with an index
+                   for fast substring (reverse incremental) search.
+    HistoryStore = Keeps each user's history in an append-only file in
+                   a directory, compacting the file when it grows to
+                   twice the history size.
+"""
+
+import bisect
+import collections
+import os
+import re
+import threading
+import urllib
+
+# An escape in a history file: \n for a newline, \\ for a backslash
+ESCAPED = re.compile(r'\\(.)')
+
+
+class History(object):
+    '''The most recent maxlen command lines.  Behaves like a list.'''
+    def __init__(self, maxlen=500, lines=(), saver=None):
+        self.maxlen = maxlen
+        # An empty tuple until the first line is added, most sessions never add one.
+        self._lines = lines and collections.deque(lines, maxlen) or ()
+        # Sequence number of self._lines[0]
+        self._first = 0
+        # Search index: trigram -> ascending list of sequence numbers.
+        # Built on the first search, stale entries are skipped and pruned.
+        self._index = None
+        self._indexed_first = 0
+        # Called with each line once it can no longer be changed
+        self._saver = saver
+        self._unsaved = None
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(self._lines)[idx]
+        return self._lines[idx]
+
+    def __setitem__(self, idx, line):
+        if idx < 0:
+            idx = idx + len(self._lines)
+        self._lines[idx] = line
+        if idx == len(self._lines) - 1 and self._unsaved is not None:
+            self._unsaved = line
+        if self._index is not None:
+            self._add_to_index(self._first + idx, line)
+
+    def append(self, line):
+        if not self._lines:
+            self._lines = collections.deque(self._lines, self.maxlen)
+        if len(self._lines) == self.maxlen:
+            self._first = self._first + 1
+        self._lines.append(line)
+        if self._index is not None:
+            self._add_to_index(self._first + len(self._lines) - 1, line)
+            if self._first - self._indexed_first > self.maxlen:
+                # Half the index refers to forgotten lines, start over.
+                self._index = None
+        if self._saver is not None:
+            # Save the previous line, the latest may still be edited (e.g. to hide a password).
+            self.flush()
+            self._unsaved = line
+
+    def flush(self):
+        '''Save the most recent line, if not already saved.'''
+        if self._unsaved is not None:
+            self._saver(self._unsaved)
+            self._unsaved = None
+
+    @staticmethod
+    def _trigrams(line):
+        return set([line[i:i+3] for i in range(len(line) - 2)])
+
+    def _add_to_index(self, seq, line):
+        for trigram in self._trigrams(line):
+            seqs = self._index.setdefault(trigram, [])
+            if seqs and seqs[-1] >= seq:
+                bisect.insort(seqs, seq)
+            else:
+                seqs.append(seq)
+
+    def _build_index(self):
+        self._index = {}
+        self._indexed_first = self._first
+        for (idx, line) in enumerate(self._lines):
+            self._add_to_index(self._first + idx, line)
+
+    def search(self, text, before=None):
+        '''Return the position of the most recent line containing text, only
+        considering lines before position before.  Returns -1 if none.'''
+        if before is None or before > len(self._lines):
+            before = len(self._lines)
+        if len(text) < 3:
+            # Short strings match often, a plain scan finds them quickly.
+            for idx in xrange(before - 1, -1, -1):
+                if text in self._lines[idx]:
+                    return idx
+            return -1
+        if self._index is None:
+            self._build_index()
+        # Walk back through the rarest trigram's lines, checking each.
+        candidates = None
+        for trigram in self._trigrams(text):
+            seqs = self._index.get(trigram)
+            if not seqs:
+                return -1
+            if candidates is None or len(seqs) < len(candidates):
+                candidates = seqs
+        pos = bisect.bisect_left(candidates, self._first + before) - 1
+        while pos >= 0:
+            seq = candidates[pos]
+            if seq < self._first:
+                break
+            if text in self._lines[seq - self._first]:
+                return seq - self._first
+            pos = pos - 1
+        return -1
+
+
+class HistoryStore(object):
+    '''Per user history files in a directory.'''
+    def __init__(self, directory, compact_ratio=2):
+        self.directory = directory
+        self.compact_ratio = compact_ratio
+        # filename -> [lock, number of lines in the file]
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def filename(self, username):
+        return os.path.join(self.directory, urllib.quote(username, safe='') + '.history')
+
+    @staticmethod
+    def _encode(line):
+        return line.replace('\\', '\\\\').replace('\n', '\\n') + '\n'
+
+    @staticmethod
+    def _decode(text):
+        # In one pass, the \\ of an escaped backslash must not start a \n.
+        return ESCAPED.sub(lambda m: m.group(1) == 'n' and '\n' or m.group(1), text[:-1])
+
+    def _file(self, filename):
+        self._lock.acquire()
+        try:
+            return self._files.setdefault(filename, [threading.Lock(), None])
+        finally:
+            self._lock.release()
+
+    def load(self, username, maxlen=500):
+        '''Return a History of the user's most recent lines, saving new lines to the file.'''
+        filename = self.filename(username)
+        entry = self._file(filename)
+        entry[0].acquire()
+        try:
+            count = 0
+            lines = collections.deque(maxlen=maxlen)
+            try:
+                f = open(filename)
+            except IOError:
+                pass
+            else:
+                try:
+                    for text in f:
+                        lines.append(text)
+                        count = count + 1
+                finally:
+                    f.close()
+            entry[1] = count
+        finally:
+            entry[0].release()
+        return History(maxlen, [self._decode(text) for text in lines],
+                       saver=lambda line: self.save(filename, line, maxlen))
+
+    def save(self, filename, line, maxlen):
+        '''Append a line to the history file, compacting it if needed.'''
+        entry = self._file(filename)
+        entry[0].acquire()
+        try:
+            f = open(filename, 'a')
+            try:
+                f.write(self._encode(line))
+            finally:
+                f.close()
+            if entry[1] is not None:
+                entry[1] = entry[1] + 1
+                if entry[1] > maxlen * self.compact_ratio:
+                    self._compact(filename, maxlen)
+                    entry[1] = maxlen
+        finally:
+            entry[0].release()
+
+    def _compact(self, filename, maxlen):
+        '''Rewrite the file with only the most recent maxlen lines.'''
+        f = open(filename)
+        try:
+            lines = collections.deque(f, maxlen)
+        finally:
+            f.close()
+        tmpname = filename + '.tmp'
+        f = open(tmpname, 'w')
+        try:
+            f.writelines(lines)
+        finally:
+            f.close()
+        os.rename(tmpname, filename)
@@ -0,0 +1,171 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""Server metrics
+
+Set a sink as the handler's metrics class member and every session
+reports to it.  A sink is any object with these methods, each given a
+metric name, a number and an optional dictionary of labels:
+
+    inc(name, value, labels)      Add to a counter
+    add(name, value, labels)      Add to (or subtract from) a gauge
+    observe(name, value, labels)  Record a value, such as a latency in
+                                  seconds, in a histogram
+
+    Metrics            = A sink keeping the metrics in memory, able to
+                         write them in the Prometheus text format.
+    PrometheusListener = Serves a Metrics sink over HTTP for Prometheus
+                         to scrape.
+
+Metrics reported by the handler:
+
+    bytes_in_total, bytes_out_total    Bytes read from and sent to clients
+    recv_calls_total, send_calls_total Socket reads and writes
+    cooked_chars_total                 Characters passed on by the input cooker
+    commands_total{command}            Commands run
+    command_errors_total{command}      Exceptions passed to handleException
+    sessions_active{backend}           Connected sessions
+    command_seconds{command}           Time to run each command
+    negotiation_seconds                Time from connecting to the client's
+                                       last option reply before the session starts
+    first_prompt_seconds               Time from connecting to the first prompt
+"""
+
+import bisect
+import threading
+import BaseHTTPServer
+
+
+class Metrics(object):
+    '''Thread safe in-memory metrics sink.'''
+    # Upper bounds of the histogram buckets, in seconds
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix='telnetsrv_', buckets=None):
+        self.prefix = prefix
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        # (name, labels) -> value
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [count in each bucket, sum, count]
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return (name, ())
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, labels=None):
+        key = self._key(name, labels)
+        self._lock.acquire()
+        self.counters[key] = self.counters.get(key, 0) + value
+        self._lock.release()
+
+    def add(self, name, value, labels=None):
+        key = self._key(name, labels)
+        self._lock.acquire()
+        self.gauges[key] = self.gauges.get(key, 0) + value
+        self._lock.release()
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        self._lock.acquire()
+        try:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            if idx < len(self.buckets):
+                histogram[0][idx] += 1
+            histogram[1] += value
+            histogram[2] += 1
+        finally:
+            self._lock.release()
+
+    def get(self, name, labels=None):
+        '''Return the value of a counter or gauge, 0 if never reported.'''
+        key = self._key(name, labels)
+        return self.counters.get(key, self.gauges.get(key, 0))
+
+    def _labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                                  for (k, v) in labels])
+
+    def exposition(self):
+        '''Return all metrics in the Prometheus text exposition format.'''
+        self._lock.acquire()
+        try:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted([(key, (list(h[0]), h[1], h[2])) for (key, h) in self.histograms.items()])
+        finally:
+            self._lock.release()
+        lines = []
+        typed = set()
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in items:
+                name = self.prefix + name
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s %s' % (name, kind))
+                lines.append('%s%s %s' % (name, self._labels(labels), value))
+        for (name, labels), (counts, total, count) in histograms:
+            name = self.prefix + name
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append('%s_bucket%s %d' % (name, self._labels(labels, [('le', repr(float(bound)))]), cumulative))
+            lines.append('%s_bucket%s %d' % (name, self._labels(labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %r' % (name, self._labels(labels), total))
+            lines.append('%s_count%s %d' % (name, self._labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusListener(object):
+    '''Serve a Metrics sink at http://host:port/metrics from a background thread.
+    Listens on the loopback interface unless told otherwise.'''
+    def __init__(self, metrics, port=9464, host='127.0.0.1'):
+        self.metrics = metrics
+        listener = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = listener.metrics.exposition()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        '''Start serving in a daemon thread.'''
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stop serving and close the listening socket.'''
+        self.server.shutdown()
+        self.server.server_close()
@@ -8,6 +8,7 @@ from paramiko import Transport, ServerInterface, RSAKey, DSSKey, SSHException, \
                     OPEN_SUCCEEDED, OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED, \
                     OPEN_FAILED_UNKNOWN_CHANNEL_TYPE, OPEN_FAILED_RESOURCE_SHORTAGE
 
+from auth import call_with_timeout
 
 log = logging.getLogger(__name__)
 
@@ -15,7 +16,7 @@ def getRsaKeyFile(filename, password=None):
     try:
         key = RSAKey(filename=filename, password=password)
     except IOError:
-        log.info('Generating new server RSA key and saving in file %r.' % filename)
+        log.info('Generating new server RSA key and saving in file %r.', filename)
         key = RSAKey.generate(1024)
         key.write_private_key_file(filename, password=password)
     return key
@@ -30,6 +31,11 @@ class TelnetToPtyHandler(object):
     DOACK = {}
     WILLACK = {}
     
+    def setup(self):
+        '''Let the SSH handler find this handler to pass on window size changes.'''
+        self.request.handler = self
+        super(TelnetToPtyHandler, self).setup()
+
     # Do not ask for auth in the PTY, it'll be handled via SSH, then passed in with the request
     def authentication_ok(self):
         '''Checks the authentication and sets the username of the currently connected terminal.  Returns True or False'''
@@ -51,6 +57,7 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
         
         # Keep track of channel information from the transport
         self.channels = {}
+        self.pty_requests = {}
         
         self.client = request._sock
         # Transport turns the socket into an SSH transport
@@ -70,7 +77,7 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
     
     def setup(self):
         '''Setup the connection.'''
-        log.debug( 'New request from address %s, port %d',  self.client_address )
+        log.debug( 'New request from address %s, port %d',  *self.client_address )
         
         try:
             self.transport.load_server_moduli()
@@ -135,7 +142,7 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
 
     def set_username(self, username):
         self.username = username
-        log.info('User logged in: %s' % username)
+        log.info('User logged in: %s', username)
 
     ######  Handle User Authentication ######
     
@@ -144,6 +151,13 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
     authCallbackKey = None
     authCallbackUsername = None
 
+    # Seconds to wait for a callback (None to call it inline)
+    authTimeout = None
+    # Shared cache of successful authentications (auth.AuthCache)
+    authCache = None
+    # Shared failed authentication throttle (auth.AuthThrottle)
+    authThrottle = None
+
     def get_allowed_auths(self, username):
         methods = []
         if self.authCallbackUsername is not None:
@@ -160,26 +174,43 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
         log.debug('Configured authentication methods: %r', methods)    
         return ','.join(methods)
 
+    def check_auth(self, method, callback, username, *args):
+        '''Run one authentication callback, honoring the cache, throttle and timeout.'''
+        address = self.client_address[0]
+        if self.authThrottle and self.authThrottle.blocked(address):
+            log.info('Too many failed logins from %s, not authenticating.', address)
+            return AUTH_FAILED
+        credentials = [method, username]
+        for arg in args:
+            if hasattr(arg, 'get_base64'):
+                # Keys are cached by their public data, not by the object.
+                arg = arg.get_base64()
+            credentials.append(arg)
+        if not (self.authCache and self.authCache.check(*credentials)):
+            try:
+                if self.authTimeout is None:
+                    callback(username, *args)
+                else:
+                    call_with_timeout(self.authTimeout, callback, username, *args)
+            except:
+                if self.authThrottle:
+                    self.authThrottle.failure(address)
+                return AUTH_FAILED
+            if self.authCache:
+                self.authCache.store(*credentials)
+        if self.authThrottle:
+            self.authThrottle.success(address)
+        self.set_username(username)
+        return AUTH_SUCCESSFUL
+
     def check_auth_password(self, username, password):
         #print 'check_auth_password(%s, %s)' % (username, password)
-        try:
-            self.authCallback(username, password)
-        except:
-            return AUTH_FAILED
-        else:
-            self.set_username(username)
-            return AUTH_SUCCESSFUL
+        return self.check_auth('password', self.authCallback, username, password)
         
 
     def check_auth_publickey(self, username, key):
         #print 'Auth attempt with key: ' + hexlify(key.get_fingerprint())
-        try:
-            self.authCallbackKey(username, key)
-        except:
-            return AUTH_FAILED
-        else:
-            self.set_username(username)
-            return AUTH_SUCCESSFUL
+        return self.check_auth('publickey', self.authCallbackKey, username, key)
         #if (username == 'xx') and (key == self.good_pub_key):
         #    return AUTH_SUCCESSFUL
         
@@ -188,13 +219,7 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
         if self.authCallbackUsername is None:
             self.set_username(username)
             return AUTH_SUCCESSFUL
-        try:
-            self.authCallbackUsername(username)
-        except:
-            return AUTH_FAILED
-        else:
-            self.set_username(username)
-            return AUTH_SUCCESSFUL
+        return self.check_auth('none', self.authCallbackUsername, username)
 
 
     def check_channel_shell_request(self, channel):
@@ -213,18 +238,35 @@ class SSHHandler(ServerInterface, BaseRequestHandler):
         #self.sshterm = term
         #print "term: %r, modes: %r" % (term, modes)
         log.debug('PTY requested.  Setting up %r.', self.telnet_handler)
+        request = self.dummy_request()
+        request._sock = channel
+        request.modes = modes
+        request.term = term
+        request.width = width
+        request.height = height
+        request.username = self.username
+        self.pty_requests[channel] = request
         pty_thread = Thread( target=self.start_pty_request, args=(channel, term, modes) )
         self.channels[channel] = pty_thread
         
         return True
 
+    def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
+        '''The client's terminal was resized.'''
+        try:
+            request = self.pty_requests[channel]
+        except KeyError:
+            return False
+        request.width = width
+        request.height = height
+        handler = getattr(request, 'handler', None)
+        if handler is not None:
+            handler.setwindowsize(width, height)
+        return True
+
     def start_pty_request(self, channel, term, modes):
         '''Start a PTY - intended to run it a (green)thread.'''
-        request = self.dummy_request()
-        request._sock = channel
-        request.modes = modes
-        request.term = term
-        request.username = self.username
+        request = self.pty_requests[channel]
 
         # modes = http://www.ietf.org/rfc/rfc4254.txt page 18
         # for i in xrange(50):
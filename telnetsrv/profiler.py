@@ -0,0 +1,128 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""Command profiling
+
+A CommandProfiler shared by the sessions of a handler class profiles
+the next few runs of chosen commands with cProfile, adding up the
+statistics of each command in memory.  Use the hidden profile command,
+or call arm() from the server, to choose the commands.
+
+cProfile only follows the session's own thread.  With the green
+backends, time spent in other greenlets while the command waits shows
+up under the call that switched away.
+"""
+
+import cProfile
+import pstats
+import StringIO
+import threading
+
+
+class CommandProfiler(object):
+    '''Profiles the next runs of armed commands.'''
+    def __init__(self):
+        # command name -> runs still to profile
+        self.armed = {}
+        # command name -> pstats.Stats, runs profiled
+        self._stats = {}
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def arm(self, cmd, count=1):
+        '''Profile the next count runs of the command.'''
+        self._lock.acquire()
+        try:
+            self.armed[cmd] = self.armed.get(cmd, 0) + count
+        finally:
+            self._lock.release()
+
+    def disarm(self, cmd=None):
+        '''Stop profiling the command, or all commands.'''
+        self._lock.acquire()
+        try:
+            if cmd is None:
+                self.armed.clear()
+            else:
+                self.armed.pop(cmd, None)
+        finally:
+            self._lock.release()
+
+    def claim(self, cmd):
+        '''Return True if this run of the command should be profiled.'''
+        self._lock.acquire()
+        try:
+            count = self.armed.get(cmd)
+            if not count:
+                return False
+            if count == 1:
+                del self.armed[cmd]
+            else:
+                self.armed[cmd] = count - 1
+            return True
+        finally:
+            self._lock.release()
+
+    def runcall(self, cmd, func, *args):
+        '''Call func(*args) under the profiler, adding to the command's statistics.'''
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            profile.create_stats()
+            self._lock.acquire()
+            try:
+                stats = self._stats.get(cmd)
+                if stats is None:
+                    self._stats[cmd] = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+                self._runs[cmd] = self._runs.get(cmd, 0) + 1
+            finally:
+                self._lock.release()
+
+    def commands(self):
+        '''Return a sorted list of (command, runs profiled) pairs.'''
+        self._lock.acquire()
+        try:
+            return sorted(self._runs.items())
+        finally:
+            self._lock.release()
+
+    def report(self, cmd, sort='cumulative', limit=25):
+        '''Return the command's statistics as text, or None if it wasn't profiled.'''
+        self._lock.acquire()
+        try:
+            stats = self._stats.get(cmd)
+            if stats is None:
+                return None
+            stream = StringIO.StringIO()
+            stats.stream = stream
+            stats.sort_stats(sort).print_stats(limit)
+            return stream.getvalue()
+        finally:
+            self._lock.release()
+
+    def dump(self, cmd, filename):
+        '''Write the command's statistics to a file for pstats or a viewer.  Return False if it wasn't profiled.'''
+        self._lock.acquire()
+        try:
+            stats = self._stats.get(cmd)
+            if stats is None:
+                return False
+            stats.dump_stats(filename)
+            return True
+        finally:
+            self._lock.release()
+
+    def clear(self, cmd=None):
+        '''Forget the statistics of the command, or of all commands.'''
+        self._lock.acquire()
+        try:
+            if cmd is None:
+                self._stats.clear()
+                self._runs.clear()
+            else:
+                self._stats.pop(cmd, None)
+                self._runs.pop(cmd, None)
+        finally:
+            self._lock.release()
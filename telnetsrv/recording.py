@@ -0,0 +1,214 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""Session recording
+
+Set a SessionRecorder as the handler's recorder class member to record
+logged in sessions in asciicast v2 format, for replay with asciinema.
+The terminal output, each line of input (not hidden input such as
+passwords) and window size changes are recorded.
+
+Sessions only queue their events, a single background thread writes
+them in batches, so recording doesn't put the disk in the way of a
+keystroke.  The queue holds at most max_buffered bytes; if the disk
+falls behind, further output is not recorded and a marker in the
+recording says how much was lost.  A recording reaching max_size bytes
+is continued in a new file, the name numbered .2.cast, .3.cast, ...
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+import urllib
+
+log = logging.getLogger(__name__)
+
+
+class Recording(object):
+    '''The recording of one session.'''
+    def __init__(self, recorder, basename, width, height, term, title):
+        self.recorder = recorder
+        self.basename = basename
+        self.width = width
+        self.height = height
+        self.term = term
+        self.title = title
+        self.start = time.time()
+        # Bytes of events not recorded since the last one that was
+        self.dropped = 0
+        # Used by the recorder's thread
+        self.file = None
+        self.part = 0
+        self.offset = 0.0
+        self.size = 0
+
+    def output(self, text):
+        '''Record text sent to the terminal.'''
+        self.recorder._put(self, 'o', text)
+
+    def input(self, text):
+        '''Record text typed by the user.'''
+        self.recorder._put(self, 'i', text)
+
+    def resize(self, width, height):
+        '''Record a change of window size.'''
+        self.recorder._put(self, 'r', '%dx%d' % (width, height))
+
+    def close(self):
+        '''End the recording once its events are written.'''
+        self.recorder._put(self, None, '')
+
+
+class SessionRecorder(object):
+    '''Writes the recordings of every session into a directory.'''
+    def __init__(self, directory, max_size=10485760, max_buffered=1048576):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_buffered = max_buffered
+        # (recording, seconds since its start, event code, data), oldest first
+        self._events = collections.deque()
+        self._buffered = 0
+        self._counter = 0
+        self._writing = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def wants(self, handler):
+        '''Should this session be recorded?'''
+        return True
+
+    def open(self, handler):
+        '''Start recording the handler's session, return its Recording.'''
+        self._cond.acquire()
+        try:
+            self._counter += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            who = handler.username or str(handler.client_address[0])
+            basename = os.path.join(self.directory, '%s-%d-%s' % (
+                time.strftime('%Y%m%d-%H%M%S'), self._counter, urllib.quote(who, safe='')))
+        finally:
+            self._cond.release()
+        title = '%s from %s' % (handler.username or 'session', handler.client_address[0])
+        return Recording(self, basename, handler.WIDTH, handler.HEIGHT, handler.TERM, title)
+
+    def _put(self, recording, code, data):
+        now = time.time() - recording.start
+        self._cond.acquire()
+        try:
+            if code is not None and self._buffered + len(data) > self.max_buffered:
+                recording.dropped += len(data)
+                return
+            if recording.dropped:
+                self._events.append((recording, now, 'm', '%d bytes not recorded' % recording.dropped))
+                recording.dropped = 0
+            self._events.append((recording, now, code, data))
+            self._buffered += len(data)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def flush(self):
+        '''Wait until every queued event is written.'''
+        while True:
+            self._cond.acquire()
+            try:
+                if not self._events and not self._writing:
+                    return
+            finally:
+                self._cond.release()
+            time.sleep(0.01)
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._events:
+                    self._cond.wait()
+                events = self._events
+                self._events = collections.deque()
+                self._buffered = 0
+                self._writing = True
+            finally:
+                self._cond.release()
+            try:
+                self._write(events)
+            except Exception:
+                log.exception('Error writing session recordings')
+            self._cond.acquire()
+            self._writing = False
+            self._cond.release()
+
+    def _write(self, events):
+        '''Write a batch of events, grouped by recording.'''
+        lines = collections.OrderedDict()
+        for (recording, when, code, data) in events:
+            pending = lines.setdefault(recording, [])
+            if code is None:
+                pending.append(None)
+            else:
+                pending.append((when, code, data))
+        for (recording, pending) in lines.items():
+            # One recording's error must not cost the others their events.
+            try:
+                self._write_recording(recording, pending)
+            except Exception:
+                log.exception('Error writing session recording %s', recording.basename)
+                if None in pending and recording.file is not None:
+                    # The session has ended, don't leave its file open.
+                    (f, recording.file) = (recording.file, None)
+                    try:
+                        f.close()
+                    except (IOError, OSError):
+                        pass
+
+    def _write_recording(self, recording, pending):
+        out = []
+        for event in pending:
+            if event is None:
+                self._flush(recording, out)
+                out = []
+                if recording.file is not None:
+                    recording.file.close()
+                    recording.file = None
+                continue
+            (when, code, data) = event
+            if recording.file is None or recording.size >= self.max_size:
+                self._flush(recording, out)
+                out = []
+                self._next_part(recording, when)
+            if code == 'r':
+                recording.width, recording.height = [int(n) for n in data.split('x')]
+            line = json.dumps([round(when - recording.offset, 6), code,
+                               data.decode('utf-8', 'replace')]) + '\n'
+            out.append(line)
+            recording.size += len(line)
+        self._flush(recording, out)
+
+    def _flush(self, recording, out):
+        if out and recording.file is not None:
+            recording.file.write(''.join(out))
+            recording.file.flush()
+
+    def _next_part(self, recording, when):
+        '''Start a new file for the recording, with its own header.'''
+        if recording.file is not None:
+            recording.file.close()
+        recording.part += 1
+        recording.offset = when
+        filename = recording.basename + (recording.part > 1 and '.%d.cast' % recording.part or '.cast')
+        recording.file = open(filename, 'w')
+        header = json.dumps({
+            'version': 2,
+            'width': recording.width,
+            'height': recording.height,
+            'timestamp': int(recording.start + when),
+            'title': recording.title,
+            'env': {'TERM': recording.term},
+        }) + '\n'
+        recording.file.write(header)
+        recording.size = len(header)
@@ -15,14 +15,111 @@ Various settings can affect the operation of the server:
                    Default: False
     authNeedPass = Should a password be requested?
                    Default: False
+    authTimeout  = Seconds to wait for authCallback, which is then
+                   run off the session's thread of control.  If None,
+                   authCallback is called inline.
+                   Default: None
+    authCache    = Shared auth.AuthCache of successful logins.
+                   Default: None
+    authThrottle = Shared auth.AuthThrottle limiting failed logins
+                   per source address.
+                   Default: None
     COMMANDS     = Dictionary of supported commands
                    Key = command (Must be upper case)
                    Value = List of (function, help text)
                    Function.__doc__ should be long help
                    Function.aliases may be a list of alternative spellings
+                   Function.completer may name a method returning
+                   TAB completions for the command's parameters
+                   Function.cache_ttl may give the seconds to keep
+                   the command's output in result_cache
+    ABBREVIATE_COMMANDS = Accept any unique prefix of a command name.
+                   Default: True
+    OUTPUT_FILTERS = Dictionary of filters usable after a | on the
+                   command line.
+                   Key = filter name (Must be upper case)
+                   Value = filters.OutputFilter subclass
+    HISTORY_SIZE = Number of command lines remembered per session.
+                   Default: 500
+    history_store = Shared history.HistoryStore keeping each user's
+                   history across sessions.
+                   Default: None
+    detached_sessions = Shared detach.DetachedSessions.  If set, a
+                   logged in user's session keeps running when the
+                   connection drops, and is continued when the user
+                   connects again.
+                   Default: None
+    BATCH        = Run every session in batch mode, for a listener
+                   dedicated to scripts.  Batch mode reads whole lines
+                   without echo, prompts or history, and ends each
+                   command's output with a line "@END OK" or
+                   "@END ERROR".  Output lines starting with @ get
+                   another @ in front.
+                   Default: False
+    BATCH_ENV    = Environment variable (sent with NEW_ENVIRON) that
+                   selects batch mode when set to 1, yes, true or on.
+                   Default: "TELNET_BATCH"
+    BATCH_OPTION = Telnet option code a client can offer (WILL) to
+                   select batch mode.
+                   Default: None
+    USE_GMCP     = Offer the GMCP option (201), letting machine clients
+                   run commands and get JSON results in subnegotiations.
+                   Default: False
+    GMCP_MAX_QUEUED = GMCP commands a session holds while one runs,
+                   more are refused until it catches up.
+                   Default: 16
+    SB_MAXLEN    = Dictionary of the longest subnegotiation accepted
+                   for each option, longer ones are discarded.
+                   Other options are limited to SB_MAXLEN_DEFAULT.
+    result_cache = Shared cache.ResultCache for the output of commands
+                   defined with cache=seconds.  Created when first
+                   needed if not set.
+                   Default: None
+    CACHE_CLEAR  = Let users empty the shared cache with cache clear,
+                   see may_clear_cache().
+                   Default: False
+    metrics      = Shared sink (see metrics.py) for the server wide
+                   counters and latency histograms.  Each session also
+                   keeps its own counters in self.counters.
+                   Default: None
+    profiler     = Shared profiler.CommandProfiler for the hidden
+                   profile command.  Created when first needed if
+                   not set.
+                   Default: None
+    PROFILE_COMMANDS = Let users run the hidden profile command, see
+                   may_profile().
+                   Default: False
+    PROFILE_DIR  = Directory profile dump writes to.  Dumping is
+                   refused if not set.
+                   Default: None
+    tracer       = Shared trace.TraceWriter.  The raw traffic and
+                   telnet commands of the sessions it wants are
+                   written to a trace file per session.
+                   Default: None
+    recorder     = Shared recording.SessionRecorder.  Logged in
+                   sessions are recorded in asciicast v2 format.
+                   Default: None
+    tls_context  = Shared ssl.SSLContext for TLS sessions, see
+                   tls.server_context().
+                   Default: None
+    TLS_IMPLICIT = Start TLS as soon as the client connects, for a
+                   telnets listener (port 992).
+                   Default: False
+    USE_STARTTLS = Offer the START_TLS option (46), switching to TLS
+                   during negotiation.
+                   Default: False
+    TLS_REQUIRED = Refuse sessions that haven't started TLS.
+                   Default: False
+    RELAY_CHUNK  = Bytes read at once from either side of a relay,
+                   see relay().
+                   Default: 16384
+    RELAY_POLL   = Seconds between checks for the end of a relay
+                   while its target is quiet.
+                   Default: 0.5
 """
 
 import SocketServer
+import collections
 import socket
 import struct
 import sys
@@ -30,12 +127,30 @@ import traceback
 import curses.ascii
 import curses.has_key
 import curses
+import errno
+import fcntl
+import io
+import json
 import logging
+import os
+import re
+import termios
+import threading
+import time
+import UserDict
+from history import History
+from cache import ResultCache
+from profiler import CommandProfiler
+from filters import OutputAborted, FilterChain, Include, Exclude, Count, Head, Tail
 #if not hasattr(socket, 'SHUT_RDWR'):
 #    socket.SHUT_RDWR = 2
 
 log = logging.getLogger(__name__)
 
+# Held briefly while creating an object shared by every session of a
+# class, or changing state a session shares between its tasks
+_shared_lock = threading.Lock()
+
 BELL = chr(7)
 ESC  = chr(27)
 ANSI_START_SEQ = '['
@@ -64,6 +179,15 @@ EC  = chr(247)  # Erase Character
 EL  = chr(248)  # Erase Line
 GA  = chr(249)  # Go Ahead
 SB =  chr(250)  # Subnegotiation Begin
+xEOF = chr(236) # End of file (LINEMODE)
+
+# Put in the input queue once the client is gone, getc raises EOFError for it
+SESSION_CLOSED = object()
+
+# Input the input cooker passes on unchanged in batch mode
+BATCH_TEXT = re.compile('[^%s\r\x03]*' % IAC)
+# Subnegotiation data up to the next IAC
+SB_TEXT = re.compile('[^%s]*' % IAC)
 
 BINARY = chr(0) # 8-bit data path
 ECHO = chr(1) # echo
@@ -122,12 +246,34 @@ FORWARD_X = chr(49) # FORWARD_X
 PRAGMA_LOGON = chr(138) # TELOPT PRAGMA LOGON
 SSPI_LOGON = chr(139) # TELOPT SSPI LOGON
 PRAGMA_HEARTBEAT = chr(140) # TELOPT PRAGMA HEARTBEAT
+GMCP = chr(201) # Generic MUD Communication Protocol
 EXOPL = chr(255) # Extended-Options-List
 NOOPT = chr(0)
 
 #Codes used in SB SE data stream for terminal type negotiation
 IS = chr(0)
 SEND = chr(1)
+INFO = chr(2)
+
+#Codes used in SB SE data stream for START_TLS negotiation
+FOLLOWS = chr(1)
+
+#Codes used in SB SE data stream for environment negotiation (RFC 1572)
+ENV_VAR = chr(0)
+ENV_VALUE = chr(1)
+ENV_ESC = chr(2)
+ENV_USERVAR = chr(3)
+
+#Codes used in SB SE data stream for LINEMODE negotiation (RFC 1184)
+LM_MODE = chr(1)
+LM_FORWARDMASK = chr(2)
+LM_SLC = chr(3)
+MODE_EDIT = 1
+MODE_TRAPSIG = 2
+MODE_ACK = 4
+SLC_LEVELBITS = 3
+SLC_NOSUPPORT = 0
+SLC_ACK = 128
 
 CMDS = {
     WILL: 'WILL',
@@ -185,13 +331,67 @@ CMDS = {
     AUTHENTICATION: 'Authenticate',
     ENCRYPT: 'Encryption option',
     NEW_ENVIRON: 'New - Environment variables',
+    GMCP: 'Generic MUD Communication Protocol',
 }
 
+# Option negotiation states (RFC 1143 "Q method"), for each side of an option
+Q_NO = 0
+Q_YES = 1
+Q_WANTNO = 2
+Q_WANTYES = 3
+# Queue bit: the opposite was asked for while a request was pending
+Q_OPPOSITE = 4
+
+# Negotiation events
+Q_RECV_YES = 1      # Received WILL (or DO), and we agree
+Q_RECV_REFUSE = 2   # Received WILL (or DO), and we don't agree
+Q_RECV_NO = 3       # Received WONT (or DONT)
+Q_ASK_YES = 4       # We want the option enabled
+Q_ASK_NO = 5        # We want the option disabled
+
+def _q_transitions():
+    '''Return the RFC 1143 table: (state, event) -> (new state, reply).
+    The reply is True to send WILL (or DO), False to send WONT (or DONT),
+    None to send nothing.'''
+    table = {}
+    table[Q_NO, Q_RECV_YES] = (Q_YES, True)
+    table[Q_NO, Q_RECV_REFUSE] = (Q_NO, False)
+    table[Q_NO, Q_RECV_NO] = (Q_NO, None)
+    table[Q_NO, Q_ASK_YES] = (Q_WANTYES, True)
+    table[Q_NO, Q_ASK_NO] = (Q_NO, None)
+    table[Q_YES, Q_RECV_YES] = (Q_YES, None)
+    table[Q_YES, Q_RECV_REFUSE] = (Q_YES, None)
+    table[Q_YES, Q_RECV_NO] = (Q_NO, False)
+    table[Q_YES, Q_ASK_YES] = (Q_YES, None)
+    table[Q_YES, Q_ASK_NO] = (Q_WANTNO, False)
+    # Agreement answering our DONT is an error, the queue bit decides the state.
+    for event in (Q_RECV_YES, Q_RECV_REFUSE):
+        table[Q_WANTNO, event] = (Q_NO, None)
+        table[Q_WANTNO | Q_OPPOSITE, event] = (Q_YES, None)
+        table[Q_WANTYES, event] = (Q_YES, None)
+        table[Q_WANTYES | Q_OPPOSITE, event] = (Q_WANTNO, False)
+    table[Q_WANTNO, Q_RECV_NO] = (Q_NO, None)
+    table[Q_WANTNO | Q_OPPOSITE, Q_RECV_NO] = (Q_WANTYES, True)
+    table[Q_WANTYES, Q_RECV_NO] = (Q_NO, None)
+    table[Q_WANTYES | Q_OPPOSITE, Q_RECV_NO] = (Q_NO, None)
+    # While a request is pending, asking only sets or clears the queue bit.
+    table[Q_WANTNO, Q_ASK_YES] = (Q_WANTNO | Q_OPPOSITE, None)
+    table[Q_WANTNO | Q_OPPOSITE, Q_ASK_YES] = (Q_WANTNO | Q_OPPOSITE, None)
+    table[Q_WANTYES, Q_ASK_YES] = (Q_WANTYES, None)
+    table[Q_WANTYES | Q_OPPOSITE, Q_ASK_YES] = (Q_WANTYES, None)
+    table[Q_WANTNO, Q_ASK_NO] = (Q_WANTNO, None)
+    table[Q_WANTNO | Q_OPPOSITE, Q_ASK_NO] = (Q_WANTNO, None)
+    table[Q_WANTYES, Q_ASK_NO] = (Q_WANTYES | Q_OPPOSITE, None)
+    table[Q_WANTYES | Q_OPPOSITE, Q_ASK_NO] = (Q_WANTYES | Q_OPPOSITE, None)
+    return table
+
+Q_TABLE = _q_transitions()
+
 
 
 class command():
     '''Function decorator to define a telnet command.'''
-    def __init__(self, names, hidden=False):
+    def __init__(self, names, hidden=False, completer=None, cache=None):
         if type(names) is str:
             self.name = names
             self.alias = []
@@ -199,6 +399,8 @@ class command():
             self.name = names[0]
             self.alias = names[1:]
         self.hidden = hidden
+        self.completer = completer
+        self.cache = cache
     
     def __call__(self, fn):
         try:
@@ -208,15 +410,154 @@ class command():
             fn.aliases.extend(self.alias)
             fn.command_name = self.name
             fn.hidden = self.hidden or fn.hidden
+            fn.completer = self.completer or fn.completer
+            fn.cache_ttl = self.cache or fn.cache_ttl
         except:
             # If that didn't work, this method only has one decorator
             fn.aliases = self.alias
             fn.command_name = self.name
             fn.hidden = self.hidden
+            fn.completer = self.completer
+            fn.cache_ttl = self.cache
         return fn
         
         
 
+class FrozenDict(dict):
+    '''An empty dict shared as the default of a session attribute, it can't be changed.'''
+    def _frozen(self, *args, **kwargs):
+        raise TypeError('Shared default, use TelnetHandlerBase.own() to change it')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _frozen
+
+
+
+class OptionState(object):
+    '''The negotiation state of one telnet option: us for our side
+    (WILL/WONT), him for the client's side (DO/DONT).'''
+    __slots__ = ('us', 'him')
+
+    def __init__(self):
+        self.us = Q_NO
+        self.him = Q_NO
+
+
+
+class CommandMap(UserDict.DictMixin, object):
+    '''A session's commands: command name -> bound method.
+    Holds only the handler and its class's table of command name -> method
+    name, methods are bound when looked up.  Commands added to a session
+    are kept apart from the shared table, and the names of class commands
+    deleted from it in a set of their own.'''
+    __slots__ = ('handler', 'table', 'added', 'removed')
+
+    def __init__(self, handler, table):
+        self.handler = handler
+        self.table = table
+        self.added = None
+        self.removed = None
+
+    def __getitem__(self, name):
+        if self.added and name in self.added:
+            return self.added[name]
+        if self.removed and name in self.removed:
+            raise KeyError(name)
+        return getattr(self.handler, self.table[name])
+
+    def __contains__(self, name):
+        if self.added and name in self.added:
+            return True
+        return name in self.table and not (self.removed and name in self.removed)
+
+    def has_key(self, name):
+        return name in self
+
+    def keys(self):
+        if not self.added and not self.removed:
+            return self.table.keys()
+        return list((set(self.table) - (self.removed or set())) | set(self.added or ()))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __setitem__(self, name, method):
+        if self.added is None:
+            self.added = {}
+        self.added[name] = method
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        if self.added and name in self.added:
+            del self.added[name]
+        if name in self.table:
+            # Hides the class's command from this session only.
+            if self.removed is None:
+                self.removed = set()
+            self.removed.add(name)
+
+
+
+class CommandTrie(object):
+    '''Prefix tree of command names, used for abbreviations and TAB completion.'''
+    def __init__(self, names=()):
+        self.root = {}
+        for name in names:
+            self.add(name)
+    
+    def add(self, name):
+        node = self.root
+        for char in name:
+            node = node.setdefault(char, {})
+        # The None key marks the end of a complete name.
+        node[None] = name
+    
+    def complete(self, prefix):
+        '''Return a sorted list of the names starting with prefix'''
+        node = self.root
+        for char in prefix:
+            try:
+                node = node[char]
+            except KeyError:
+                return []
+        names = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for key, child in node.items():
+                if key is None:
+                    names.append(child)
+                else:
+                    stack.append(child)
+        names.sort()
+        return names
+        
+        
+
+class Job(object):
+    '''A command running in the background of a session.'''
+    def __init__(self, number, cmdline, output_filter=None):
+        self.number = number
+        self.cmdline = cmdline
+        self.output_filter = output_filter
+        # The thread or greenlet running the command
+        self.task = None
+        self.done = False
+        self.killed = False
+        # Is fg waiting for this job?
+        self.foreground = False
+    
+    def status(self):
+        if self.killed:
+            return 'Killed'
+        if self.done:
+            return 'Done'
+        return 'Running'
+        
+        
+
 class InputSimple(object):
     '''Simple line handler.  All spaces become one, can have quoted parameters, but not null'''
     quote_chars = ['"', "'"]
@@ -249,6 +590,12 @@ class InputSimple(object):
                 cmdlist[idx] = cmdlist[idx][1:-1]
             idx = idx + 1
         self.parts = cmdlist
+        self.pipes = [idx for (idx, part) in enumerate(cmdlist) if part == '|']
+        self.background = len(cmdlist) > 1 and cmdlist[-1] == '&'
+
+
+# InputBashLike's compiled token patterns, see InputBashLike.scanners()
+Scanners = collections.namedtuple('Scanners', 'between inpart inside pieces escapes whole part')
 
 
 class InputBashLike(object):
@@ -259,16 +606,21 @@ class InputBashLike(object):
     escape_results = {'\\':'\\', 't':'\t', 'n':'\n', ' ':' ', '"': '"', "'":"'"}
     continue_prompt = '... '
     eol_char = '\n'
+    pipe_char = '|'
+    background_char = '&'
     
     def __init__(self, handler, line):
         self.raw = ''
         self.handler = handler
         self.complete = False
         self.inquote = False
+        self.inpart = False
         self.parts = []
         self.part = []
-        # Set up the initial processing state.
-        self.process_char = self.process_delimiter
+        # Index of each part that is an unquoted pipe symbol
+        self.pipes = []
+        # Index of the last unquoted background symbol
+        self.ampersand = None
         self.process(line)
     
     @property
@@ -282,89 +634,198 @@ class InputBashLike(object):
     def params(self):
         return self.parts[1:]
     
-    # The following process_x functions handle different states while stepping through the chars of the line.
+    @property
+    def background(self):
+        '''Does the line end with an unquoted background symbol?'''
+        return self.ampersand is not None and self.ampersand == len(self.parts) - 1 > 0
     
-    def process_delimiter(self, char):
-        '''Process chars while not in a part'''
-        if char in self.whitespace:
-            return
-        if char in self.quote_chars:
-            # Store the quote type (' or ") and switch to quote processing.
-            self.inquote = char
-            self.process_char = self.process_quote
-            return
-        if char == self.eol_char:
-            self.complete = True
-            return
-        # Switch to processing a part.
-        self.process_char = self.process_part
-        self.process_char(char)
+    @classmethod
+    def scanners(cls):
+        '''Return the Scanners of compiled token patterns, built once per class:
+            between = Tokens between parts, taking whole words in one match
+            inpart  = Tokens within a part
+            inside  = Dictionary of the tokens within each quote type
+            pieces  = Splits a part into its quoted and unquoted pieces
+            escapes = Finds the escapes of a part
+            whole   = Checks a line is made only of complete parts
+            part    = Finds each part of such a line
+        '''
+        try:
+            return cls.__dict__['_scanners']
+        except KeyError:
+            pass
+        def charset(chars):
+            return ''.join([re.escape(c) for c in chars])
+        esc = re.escape(cls.escape_char)
+        space = charset(cls.whitespace)
+        delimiter = charset(cls.whitespace + [cls.eol_char])
+        special = charset(cls.whitespace + cls.quote_chars + [cls.escape_char, cls.eol_char])
+        # An escape that doesn't continue the line
+        escaped = '%s[^%s]' % (esc, re.escape(cls.eol_char))
+        general = '(?P<space>[%s]+)|%s(?P<esc>.)|(?P<quote>[%s])|(?P<eol>%s)|(?P<text>[^%s]+)' % (
+            space, esc, charset(cls.quote_chars), re.escape(cls.eol_char), special)
+        # Between parts, whole words (plain or simply quoted) are taken in a single match.
+        words = ['(?P<word0>[^%s]+)(?=[%s])[%s]*' % (special, delimiter, space)]
+        quoted = []
+        for idx, quote in enumerate(cls.quote_chars):
+            plain = '[^%s]*' % charset([quote, cls.escape_char])
+            words.append('%s(?P<word%d>%s)%s(?=[%s])[%s]*' % (
+                re.escape(quote), idx + 1, plain, re.escape(quote), delimiter, space))
+            # Runs of plain characters between the escapes, so no character is matched twice.
+            quoted.append('%s%s(?:%s%s)*%s' % (re.escape(quote), plain, escaped, plain, re.escape(quote)))
+        # So is any other part ending on this line, with escapes and quotes glued to
+        # text, unless it starts with an escaped space: that is a part of its own.
+        words.append('(?!%s[%s])(?P<part>[^%s]*(?:(?:%s|%s)[^%s]*)+)(?=[%s])[%s]*' % (
+            esc, space, special, escaped, '|'.join(quoted), special, delimiter, space))
+        between = re.compile('|'.join(words + [general]), re.DOTALL)
+        inpart = re.compile(general, re.DOTALL)
+        inside = {}
+        for quote in cls.quote_chars:
+            plain = '[^%s]*' % charset([quote, cls.escape_char])
+            inside[quote] = re.compile(
+                '(?P<escaped>(?:[^%s]|%s)%s(?:%s%s)*)|%s(?P<esc>.)|(?P<quote>%s)' % (
+                    charset([quote, cls.escape_char]), escaped, plain, escaped, plain, esc, re.escape(quote)),
+                re.DOTALL)
+        # Splitting on quoted pieces keeps them in groups, without the quotes.  Escaped
+        # quotes and escape chars are kept too, they mustn't start or end a piece.
+        pieces = ['(%s[%s])' % (esc, charset(cls.quote_chars + [cls.escape_char]))]
+        for quote in cls.quote_chars:
+            plain = '[^%s]*' % charset([quote, cls.escape_char])
+            pieces.append('%s(%s(?:%s.%s)*)%s' % (re.escape(quote), plain, esc, plain, re.escape(quote)))
+        pieces = re.compile('|'.join(pieces), re.DOTALL)
+        escapes = re.compile('%s(.)' % esc, re.DOTALL)
+        part = '(?!%s[%s])(?=[^%s])[^%s]*(?:(?:%s|%s)[^%s]*)*' % (
+            esc, space, delimiter, special, escaped, '|'.join(quoted), special)
+        whole = re.compile('[%s]*(?:%s(?:[%s]+|(?=%s)))*%s$' % (
+            space, part, space, re.escape(cls.eol_char), re.escape(cls.eol_char)), re.DOTALL)
+        cls._scanners = Scanners(between, inpart, inside, pieces, escapes, whole, re.compile(part, re.DOTALL))
+        return cls._scanners
     
-    def process_part(self, char):
-        '''Process chars while in a part'''
-        if char in self.whitespace or char == self.eol_char:
-            # End of the part.
+    def end_part(self):
+        '''Finish the part being collected, if any'''
+        if self.inpart:
             self.parts.append( ''.join(self.part) )
             self.part = []
-            # Switch back to processing a delimiter.
-            self.process_char = self.process_delimiter
-            if char == self.eol_char:
-                self.complete = True
-            return
-        if char in self.quote_chars:
-            # Store the quote type (' or ") and switch to quote processing.
-            self.inquote = char
-            self.process_char = self.process_quote
-            return
-        self.part.append(char)
-    
-    def process_quote(self, char):
-        '''Process character while in a quote'''
-        if char == self.inquote:
-            # Quote is finished, switch to part processing.
-            self.process_char = self.process_part
-            return
-        try:
-            self.part.append(char)
-        except:
-            self.part = [ char ]
+            self.inpart = False
     
     def process_escape(self, char):
         '''Handle the char after the escape char'''
-        # Always only run once, switch back to the last processor.
-        self.process_char = self.last_process_char
-        if self.part == [] and char in self.whitespace:
+        if char == self.eol_char:
+            # Ignore a cr, the line continues.
+            return
+        if not (self.inpart or self.inquote) and char in self.whitespace:
             # Special case where \ is by itself and not at the EOL.
             self.parts.append(self.escape_char)
             return
-        if char == self.eol_char:
-            # Ignore a cr.
+        self.part.append( self.escape_results.get(char, self.escape_char+char) )
+        self.inpart = True
+    
+    def unquote(self, text):
+        '''Drop the quotes around each quoted piece of text'''
+        for quote in self.quote_chars:
+            if quote in text:
+                return ''.join(filter(None, self.scanners().pieces.split(text)))
+        return text
+
+    def unescape(self, text):
+        '''Replace the escapes in text by the characters they stand for'''
+        escape_char = self.escape_char
+        if escape_char not in text:
+            return text
+        if escape_char + escape_char not in text:
+            # Without an escaped escape char the escapes can't overlap, replace each kind in turn.
+            for (char, result) in self.escape_results.items():
+                if escape_char + char in text:
+                    text = text.replace(escape_char + char, result)
+            return text
+        # Splitting on the escapes leaves each escaped character at an odd index.
+        pieces = self.scanners().escapes.split(text)
+        results = self.escape_results
+        pieces[1::2] = [results.get(char, escape_char + char) for char in pieces[1::2]]
+        return ''.join(pieces)
+
+    def scan_parts(self, line):
+        '''Tokenize a line made only of complete parts in one pass.  Return
+        False, changing nothing, for any other line.'''
+        scanners = self.scanners()
+        if theNULL in line or line.count(self.eol_char) != 1 or not scanners.whole.match(line):
+            return False
+        found = scanners.part.findall(line)
+        if found:
+            first = len(self.parts)
+            if self.pipe_char in line or self.background_char in line:
+                for (idx, text) in enumerate(found):
+                    if text == self.pipe_char:
+                        self.pipes.append(first + idx)
+                    elif text == self.background_char:
+                        self.ampersand = first + idx
+            # Decode every part at once, NUL (not in the line) keeps them apart.
+            text = self.unquote(theNULL.join(found))
+            self.parts.extend(self.unescape(text).split(theNULL))
+        self.complete = True
+        return True
+
+    def scan(self, line):
+        '''Tokenize one line, one regex match per word or run of similar characters'''
+        if not (self.inquote or self.inpart) and self.scan_parts(line):
             return
-        unescaped = self.escape_results.get(char, self.escape_char+char)
-        self.part.append(unescaped)
-            
+        scanners = self.scanners()
+        between = scanners.between
+        inpart = scanners.inpart
+        inside = scanners.inside
+        self.complete = False
+        pos = 0
+        end = len(line)
+        while pos < end:
+            if self.inquote:
+                match = inside[self.inquote].match(line, pos)
+            elif self.inpart:
+                match = inpart.match(line, pos)
+            else:
+                match = between.match(line, pos)
+            pos = match.end()
+            kind = match.lastgroup
+            if kind[:4] == 'word':
+                if kind == 'word0' and match.group(kind) == self.pipe_char:
+                    self.pipes.append(len(self.parts))
+                elif kind == 'word0' and match.group(kind) == self.background_char:
+                    self.ampersand = len(self.parts)
+                self.parts.append(match.group(kind))
+            elif kind == 'part':
+                self.parts.append(self.unescape(self.unquote(match.group(kind))))
+            elif kind == 'escaped':
+                self.part.append(self.unescape(match.group(kind)))
+            elif kind == 'text':
+                self.part.append(match.group(kind))
+                self.inpart = True
+            elif kind == 'space':
+                self.end_part()
+            elif kind == 'esc':
+                self.process_escape(match.group(kind))
+            elif kind == 'quote':
+                if self.inquote:
+                    # Quote is finished, the part continues.
+                    self.inquote = False
+                else:
+                    # Store the quote type (' or ") and switch to quote processing.
+                    self.inquote = match.group(kind)
+                    self.inpart = True
+            else:
+                self.end_part()
+                self.complete = True
     
     def process(self, line):
-        '''Step through the line and process each character'''
-        self.raw = self.raw + line
-        try:
-            if not line[-1] == self.eol_char:
+        '''Tokenize the line, reading continuation lines until the input is complete'''
+        while True:
+            self.raw = self.raw + line
+            if not line.endswith(self.eol_char):
                 # Should always be here, but add it just in case.
                 line = line + self.eol_char
-        except IndexError:
-            # Thrown if line == ''
-            line = self.eol_char
-                
-        for char in line:
-            if char == self.escape_char:
-                # Always handle escaped characters.
-                self.last_process_char = self.process_char
-                self.process_char = self.process_escape
-                continue
-            self.process_char(char)
-        if not self.complete:
+            self.scan(line)
+            if self.complete:
+                return
             # Ask for more.
-            self.process( self.handler.readline(prompt=self.handler.CONTINUE_PROMPT) )
+            line = self.handler.readline(prompt=self.handler.CONTINUE_PROMPT)
 
 
 class TelnetHandlerBase(SocketServer.BaseRequestHandler):
@@ -387,13 +848,16 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
     WILLACK = {
         ECHO: DONT,
         SGA: DO,
-        NAWS: DONT,
+        NAWS: DO,
         TTYPE: DO,
         LINEMODE: DONT,
         NEW_ENVIRON: DO,
     }
     # Default terminal type - used if client doesn't tell us its termtype
     TERM = "ansi"
+    # Default window size - used if client doesn't tell us its window size
+    WIDTH = 80
+    HEIGHT = 24
     # Keycode to name mapping - used to decide which keys to query
     KEYS = {                    # Key escape sequences
         curses.KEY_UP: 'Up',            # Cursor up
@@ -406,6 +870,8 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
     # Reverse mapping of KEYS - used for cooking key codes
     ESCSEQ = {
     }
+    # First characters of the ESCSEQ keys
+    ESCSEQ_START = frozenset()
     # Terminal output escape sequences
     CODES = {
         'DEOL': '', # Delete to end of line
@@ -413,6 +879,8 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         'INS': '',  # Insert space
         'CSRLEFT': '',  # Move cursor left 1 space
         'CSRRIGHT': '', # Move cursor right 1 space
+        'INS_N': '',    # Insert N spaces (parameterized)
+        'CSRLEFT_N': '',    # Move cursor left N spaces (parameterized)
     }
     # What prompt to display
     PROMPT = "Telnet Server> "
@@ -426,6 +894,12 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
     authNeedUser = False
     # Does authCallback want a password?
     authNeedPass = False
+    # Seconds to wait for authCallback (None to call it inline)
+    authTimeout = None
+    # Shared cache of successful authentications (auth.AuthCache)
+    authCache = None
+    # Shared failed authentication throttle (auth.AuthThrottle)
+    authThrottle = None
     # Default username
     username = None
     # What will handle our inputs?
@@ -433,10 +907,114 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
     input_reader = InputBashLike
     # Banner to display prior to telnet login
     TELNET_ISSUE = None
+    # Accept unique abbreviations of command names?
+    ABBREVIATE_COMMANDS = True
+    # Filters that command output can be piped through
+    OUTPUT_FILTERS = {
+        'INCLUDE': Include,
+        'EXCLUDE': Exclude,
+        'COUNT': Count,
+        'HEAD': Head,
+        'TAIL': Tail,
+    }
+    # The active filter chain while a command runs
+    output_filter = None
     # What prompt to use when requesting a telnet username
     PROMPT_USER = "Username: "
     # What prompt to use when requesting a telnet password
     PROMPT_PASS = "Password: "
+    # Ask the client to edit lines locally (RFC 1184 LINEMODE)?
+    USE_LINEMODE = False
+    # In LINEMODE, characters the client should send without waiting for end of line
+    LINEMODE_FORWARD = ''
+    # Pause long command output once the client has reported its window size?
+    PAGER = True
+    # What prompt to display while paused
+    PAGER_PROMPT = "--More--"
+    # How many command lines to remember
+    HISTORY_SIZE = 500
+    # Shared HistoryStore to keep each user's history between sessions
+    history_store = None
+    # Shared DetachedSessions to keep sessions running when the connection drops
+    detached_sessions = None
+    # Shared ResultCache for commands defined with cache=seconds
+    result_cache = None
+    # May users empty the shared cache?  See may_clear_cache().
+    CACHE_CLEAR = False
+    # Sink for server wide metrics, such as a metrics.Metrics
+    metrics = None
+    # Name of the concurrency backend, reported in the sessions_active metric
+    BACKEND = None
+    # Shared CommandProfiler for the profile command
+    profiler = None
+    # May users run the profile command?  See may_profile().
+    PROFILE_COMMANDS = False
+    # Directory profile dump writes to, None to refuse dumps
+    PROFILE_DIR = None
+    # Shared TraceWriter recording the traffic of chosen sessions
+    tracer = None
+    # Shared SessionRecorder recording logged in sessions for replay
+    recorder = None
+    # Run every session in batch mode?
+    BATCH = False
+    # NEW_ENVIRON variable a client can set to select batch mode
+    BATCH_ENV = "TELNET_BATCH"
+    # Telnet option code a client can offer to select batch mode
+    BATCH_OPTION = None
+    # Line ending each command's output in batch mode, followed by OK or ERROR
+    BATCH_END = "@END"
+    # Offer GMCP, a JSON channel for machine clients?
+    USE_GMCP = False
+    # GMCP commands waiting behind the running one, more are refused
+    GMCP_MAX_QUEUED = 16
+    # Shared ssl.SSLContext for TLS, see tls.server_context()
+    tls_context = None
+    # Start TLS as soon as the client connects?
+    TLS_IMPLICIT = False
+    # Offer START_TLS to switch to TLS during negotiation?
+    USE_STARTTLS = False
+    # Refuse sessions that haven't started TLS?
+    TLS_REQUIRED = False
+    # Seconds allowed for the TLS handshake, or for the client to start it
+    TLS_TIMEOUT = 10
+    # Bytes read at once from either side of a relay
+    RELAY_CHUNK = 16384
+    # Seconds between checks for the end of a relay while its target is quiet
+    RELAY_POLL = 0.5
+    # Longest subnegotiation accepted for these options
+    SB_MAXLEN = {
+        NEW_ENVIRON: 8192,
+        GMCP: 65536,
+    }
+    # Longest subnegotiation accepted for any other option
+    SB_MAXLEN_DEFAULT = 1024
+
+    # Per session dicts, usually empty.  Sessions share these empty defaults
+    # until they need their own, see own().
+    # Environment variables sent by the client
+    ENV = FrozenDict()
+    # LINEMODE special characters, function -> (flags, value)
+    linemode_slc = FrozenDict()
+    # Background jobs by number
+    jobs = FrozenDict()
+    # Output being collected for result_cache, by task
+    _captures = FrozenDict()
+    # Completion candidates, reset for each line read
+    _completions = FrozenDict()
+    # (task, negotiation commands) held to be sent in one write, see hold_negotiation()
+    _negotiation = None
+    # GMCP commands waiting for the session's GMCP task, see gmcp_message()
+    _gmcp_queue = None
+    # Is the connection using TLS?
+    encrypted = False
+    # (task starting TLS, output of other tasks held until it is up), see starttls()
+    _tls_held = None
+    # Socket or file descriptor the client's input goes to, see relay()
+    relay_to = None
+    # Character ending the relay, the target's file descriptor, did the last input end with CR?
+    _relay_escape = None
+    _relay_fd = None
+    _relay_cr = False
 
 # --------------------------- Environment Setup ----------------------------
 
@@ -449,25 +1027,54 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         """
         # Am I doing the echoing?
         self.DOECHO = True
-        # What opts have I sent DO/DONT for and what did I send?
-        self.DOOPTS = {}
-        # What opts have I sent WILL/WONT for and what did I send?
-        self.WILLOPTS = {}
+        # Negotiation state of each option, option -> OptionState
+        self.option_states = {}
 
         # What commands does this CLI support
-        self.COMMANDS = {}
+        self.COMMANDS = CommandMap(self, self.command_table())
         self.sock = None    # TCP socket
         self.rawq = ''      # Raw input string
-        self.sbdataq = ''   # Sub-Neg string
+        self.sbdataq = bytearray()  # Sub-Neg data
+        self.sblimit = 0    # Most Sub-Neg data to accept, 0 to discard the rest
         self.eof = 0        # Has EOF been reached?
         self.iacseq = ''    # Buffer for IAC sequence.
         self.sb = 0     # Flag for SB and SE sequence.
-        self.history = []   # Command history
+        self.history = History(self.HISTORY_SIZE)   # Command history
+        self.interrupted = False    # Ctrl-C received while a command runs?
+        self.window_known = False   # Has the client told us WIDTH and HEIGHT?
+        self.linemode = False       # Is the client editing lines locally?
+        self.linebuf = ''           # Partial line from a LINEMODE client
+        self.pager_rows = None      # Rows output since the pager last paused, None when not paging
+        self.output_buffer = None   # Holds the output while the session is detached
+        self.reattached_to = None   # The detached session this connection continues
+        self.session_ended = False
+        self.batch = self.BATCH     # Reading scripted input?
+        self.gmcp = False           # Has the client agreed to GMCP?
+        self.logged_in = False      # Has authentication succeeded?
+        self.command_failed = False # Did the current command report an error?
+        self.job_counter = 0
+        self.counters = {}          # This session's metrics counters, name -> count
+        self.connect_time = time.time()
+        self.negotiate_time = None  # When the client last replied to an option
+        self.prompted = False       # Has the session asked for input yet?
+        self._cooked_reported = 0   # Cooked characters already passed to the metrics sink
+        self.trace = None           # This session's SessionTrace, if traced
+        self.recording = None       # This session's Recording, if recorded
         self.RUNSHELL = True
+        SocketServer.BaseRequestHandler.__init__(self, request, client_address, server)
+    
+    @classmethod
+    def command_table(cls):
+        '''Return the class's table of command name -> method name, built once per class.'''
+        try:
+            return cls.__dict__['_command_table']
+        except KeyError:
+            pass
         # A little magic - Everything called cmdXXX is a command
         # Also, check for decorated functions
-        for k in dir(self):
-            method = getattr(self, k)
+        table = {}
+        for k in dir(cls):
+            method = getattr(cls, k)
             try:
                 name = method.command_name
             except:
@@ -477,12 +1084,15 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
                     continue
             
             name = name.upper()
-            self.COMMANDS[name] = method
+            table[name] = k
             for alias in getattr(method, "aliases", []):
-                self.COMMANDS[alias.upper()] = self.COMMANDS[name]
-                    
-        SocketServer.BaseRequestHandler.__init__(self, request, client_address, server)
-    
+                table[alias.upper()] = k
+        # The trie of visible command names is shared by every instance of the class too.
+        cls._command_trie = CommandTrie(
+            [name for (name, k) in table.items() if not getattr(getattr(cls, k), 'hidden', False)])
+        cls._command_table = table
+        return table
+
     class false_request(object):
         def __init__(self):
             self.sock = None
@@ -501,21 +1111,52 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
 
     def setterm(self, term):
         "Set the curses structures for this terminal"
-        log.debug("Setting termtype to %s" % (term, ))
-        curses.setupterm(term) # This will raise if the termtype is not supported
+        log.debug("Setting termtype to %s", term)
+        # The tables for each terminal type are shared by every instance of the class, don't change them.
+        tables = self.__class__.__dict__.get('_term_tables')
+        if tables is None:
+            tables = self.__class__._term_tables = {}
+        if term not in tables:
+            curses.setupterm(term) # This will raise if the termtype is not supported
+            escseq = {}
+            for k in self.KEYS.keys():
+                str = curses.tigetstr(curses.has_key._capability_names[k])
+                if str:
+                    escseq[str] = k
+            # Create a copy to prevent altering the class
+            codes = self.__class__.CODES.copy()
+            codes['DEOL'] = curses.tigetstr('el')
+            codes['DEL'] = curses.tigetstr('dch1')
+            codes['INS'] = curses.tigetstr('ich1')
+            codes['CSRLEFT'] = curses.tigetstr('cub1')
+            codes['CSRRIGHT'] = curses.tigetstr('cuf1')
+            codes['INS_N'] = curses.tigetstr('ich')
+            codes['CSRLEFT_N'] = curses.tigetstr('cub')
+            tables[term] = (escseq, frozenset([seq[0] for seq in escseq]), codes)
         self.TERM = term
-        self.ESCSEQ = {}
-        for k in self.KEYS.keys():
-            str = curses.tigetstr(curses.has_key._capability_names[k])
-            if str:
-                self.ESCSEQ[str] = k
-        # Create a copy to prevent altering the class
-        self.CODES = self.CODES.copy()
-        self.CODES['DEOL'] = curses.tigetstr('el')
-        self.CODES['DEL'] = curses.tigetstr('dch1')
-        self.CODES['INS'] = curses.tigetstr('ich1')
-        self.CODES['CSRLEFT'] = curses.tigetstr('cub1')
-        self.CODES['CSRRIGHT'] = curses.tigetstr('cuf1')
+        (self.ESCSEQ, self.ESCSEQ_START, self.CODES) = tables[term]
+
+    def setwindowsize(self, width, height):
+        "Set the window size, a dimension of 0 is unknown"
+        log.debug("Setting window size to %sx%s", width, height)
+        if self.reattached_to is not None:
+            self.reattached_to.setwindowsize(width, height)
+        if width:
+            self.WIDTH = width
+        if height:
+            self.HEIGHT = height
+        self.window_known = bool(width and height)
+        if self.recording is not None:
+            self.recording.resize(self.WIDTH, self.HEIGHT)
+        if self.relay_to is not None and self.window_known:
+            self.relay_resize(self.WIDTH, self.HEIGHT)
+
+    def setnaws(self, data):
+        "Set the window size from a NAWS subnegotiation"
+        if len(data) < 4:
+            log.debug("Short NAWS subnegotiation %r", data)
+            return
+        self.setwindowsize(*struct.unpack('!HH', data[:4]))
 
     def setup(self):
         "Connect incoming connection to a telnet session"
@@ -524,96 +1165,539 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         except:
             pass
         self.setterm(self.TERM)
+        try:
+            self.setwindowsize(self.request.width, self.request.height)
+        except AttributeError:
+            pass
         self.sock = self.request._sock
+        if self.tracer is not None and self.tracer.wants(self):
+            self.trace = self.tracer.open(self)
+        if self.metrics is not None:
+            self.metrics.add('sessions_active', 1, {'backend': self.BACKEND or self.__class__.__module__})
+        if self.TLS_IMPLICIT:
+            try:
+                self.starttls()
+            except socket.error:
+                # Already logged by starttls.  End the session quietly: handle()
+                # returns at once.  Not eof, the input cooker may still read.
+                self.session_ended = True
+                return
+        self.hold_negotiation()
         for k in self.DOACK.keys():
             self.sendcommand(self.DOACK[k], k)
+        if self.USE_GMCP:
+            self.sendcommand(WILL, GMCP)
+        if self.willack(TLS) == DO:
+            self.sendcommand(DO, TLS)
         for k in self.WILLACK.keys():
-            self.sendcommand(self.WILLACK[k], k)
+            self.sendcommand(self.willack(k), k)
+        self.send_negotiation()
         
 
     def finish(self):
         "End this session"
         log.debug("Session disconnected.")
+        self.session_ended = True
+        if self.detached_sessions is not None:
+            self.detached_sessions.discard(self)
         try:
             self.sock.shutdown(socket.SHUT_RDWR)
         except: pass
-        self.session_end()
+        if self.reattached_to is None:
+            self.history.flush()
+            for job in self.jobs.values():
+                self.kill_job(job)
+            self.session_end()
+            if self.recording is not None:
+                self.recording.close()
+        if self.trace is not None:
+            self.trace.close()
+        self.count_cooked()
+        if self.metrics is not None:
+            self.metrics.add('sessions_active', -1, {'backend': self.BACKEND or self.__class__.__module__})
 
     def session_start(self):
         pass
+
+    def own(self, name):
+        "Return this session's own dict for the attribute, in place of the shared empty default"
+        # setdefault is atomic, so tasks of the session can't create two.
+        return self.__dict__.setdefault(name, {})
+
+    def count(self, name, value=1, labels=None):
+        "Add to one of this session's counters and to the server wide metrics"
+        self.counters[name] = self.counters.get(name, 0) + value
+        if self.metrics is not None:
+            self.metrics.inc(name, value, labels)
+
+    def count_cooked(self):
+        "Pass the characters cooked since the last call on to the metrics sink"
+        cooked = self.counters.get('cooked_chars_total', 0)
+        if self.metrics is not None and cooked > self._cooked_reported:
+            self.metrics.inc('cooked_chars_total', cooked - self._cooked_reported)
+        self._cooked_reported = cooked
+
+    def observe(self, name, value, labels=None):
+        "Record a value, such as a latency, in a server wide histogram"
+        if self.metrics is not None:
+            self.metrics.observe(name, value, labels)
         
     def session_end(self):
         pass
 
+    def detach(self):
+        "Keep the session running without a connection.  Return False if it can't be detached."
+        if self.output_buffer is not None:
+            return True
+        if (self.detached_sessions is None or not self.username or not self.RUNSHELL
+                or self.session_ended or self.reattached_to is not None):
+            return False
+        # Nobody is there to page through the output.
+        self.pager_rows = None
+        self.output_buffer = self.detached_sessions.detach(self)
+        log.info("Session of %s detached.", self.username)
+        return True
+
+    def connection_lost(self):
+        "The client has gone.  Wait for a reattach if the session is detached, else end it."
+        if self.reattached_to is not None:
+            # handle() passes this on to the session the connection was continuing.
+            self.eof = True
+            return
+        if not self.detach():
+            self.inputcooker_store_queue(SESSION_CLOSED)
+            return
+        self.eof = False
+        buffer = self.output_buffer
+        deadline = time.time() + self.detached_sessions.timeout
+        while self.output_buffer is buffer and not self.session_ended and time.time() < deadline:
+            self.sleep(1)
+        if self.output_buffer is buffer and self.detached_sessions.discard(self):
+            log.info("Detached session of %s timed out.", self.username)
+            self.eof = True
+            self.inputcooker_store_queue(SESSION_CLOSED)
+
+    def reattach(self, connection):
+        "Continue this detached session on the connection of a new handler."
+        log.info("Session of %s reattached.", self.username)
+        connection.writeline("Reattaching to your detached session.")
+        connection.reattached_to = self
+        self.DOECHO = connection.DOECHO
+        self.option_states = connection.option_states
+        self.linemode = connection.linemode
+        if connection.window_known:
+            self.setwindowsize(connection.WIDTH, connection.HEIGHT)
+        # New output goes to the new connection once the buffer is empty.
+        self.sock = connection.sock
+        buffer = self.output_buffer
+        while True:
+            text = buffer.drain()
+            if not text:
+                break
+            connection.writecooked(text)
+        self.output_buffer = None
+
+    #abstractmethod
+    def sleep(self, seconds):
+        """Pause this session without blocking others"""
+        raise NotImplementedError("Please Implement the sleep method")
+
 # ------------------------- Telnet Options Engine --------------------------
 
+    def willack(self, opt):
+        "What to ask of the client for this option (DO or DONT)"
+        if opt == LINEMODE and self.USE_LINEMODE:
+            return DO
+        if self.BATCH_OPTION is not None and opt == self.BATCH_OPTION:
+            return DO
+        if opt == TLS:
+            return (self.USE_STARTTLS and self.tls_context is not None and not self.encrypted
+                    and not self.logged_in) and DO or DONT
+        if opt == BINARY and self.relay_to is not None:
+            return DO
+        return self.WILLACK.get(opt, DONT)
+
+    def doack(self, opt):
+        "What to answer the client asking us to perform this option (WILL or WONT)"
+        if opt == GMCP and self.USE_GMCP:
+            return WILL
+        if opt == ECHO and self.linemode:
+            # The client echoes while it edits lines, only our own requests change that.
+            return WONT
+        if opt == BINARY and self.relay_to is not None:
+            return WILL
+        return self.DOACK.get(opt, WONT)
+
+    def option_state(self, opt):
+        "Return the OptionState of the option"
+        state = self.option_states.get(opt)
+        if state is None:
+            state = self.option_states[opt] = OptionState()
+        return state
+
+    def option_active(self, opt, local=False):
+        "Is the option enabled?  local for an option we perform, otherwise one the client performs"
+        state = self.option_states.get(opt)
+        if state is None:
+            return False
+        if local:
+            return state.us == Q_YES
+        return state.him == Q_YES
+
+    def negotiate(self, opt, local, event):
+        "Move one side of the option through the Q method table, sending any reply"
+        state = self.option_state(opt)
+        if local:
+            old = state.us
+            new, reply = Q_TABLE[old, event]
+            state.us = new
+            if reply is not None:
+                self.writenegotiation(IAC + (reply and WILL or WONT) + opt)
+        else:
+            old = state.him
+            new, reply = Q_TABLE[old, event]
+            state.him = new
+            if reply is not None:
+                self.writenegotiation(IAC + (reply and DO or DONT) + opt)
+        if new == Q_YES and old != Q_YES:
+            self.option_enabled(opt, local)
+        elif old == Q_YES and new != Q_YES:
+            self.option_disabled(opt, local)
+
+    def option_enabled(self, opt, local):
+        """Called when an option is enabled: local for our side (the client
+        sent DO), otherwise the client's side (it sent WILL).
+        Override to act on more options, calling back to this method."""
+        if local:
+            if opt == ECHO and not self.linemode:
+                self.DOECHO = True
+            elif opt == GMCP:
+                self.gmcp = True
+            return
+        if opt == TTYPE:
+            self.writenegotiation(IAC + SB + TTYPE + SEND + IAC + SE)
+        elif opt == NEW_ENVIRON:
+            # Ask for all variables.
+            self.writesb(NEW_ENVIRON, SEND)
+        elif opt == LINEMODE and self.USE_LINEMODE:
+            self.linemode_start()
+        elif opt == TLS and not self.encrypted and self._tls_held is None:
+            # Nothing more goes out before TLS, which the client starts once it replies.
+            self._tls_held = (self.current_task(), [])
+            self.writesb(TLS, FOLLOWS)
+        if self.BATCH_OPTION is not None and opt == self.BATCH_OPTION:
+            log.debug("Client selected batch mode")
+            self.batch = True
+
+    def option_disabled(self, opt, local):
+        """Called when an option is disabled, local as for option_enabled.
+        Override to act on more options, calling back to this method."""
+        if local:
+            if opt == ECHO and not self.linemode:
+                self.DOECHO = False
+            elif opt == GMCP:
+                self.gmcp = False
+        elif opt == LINEMODE:
+            self.linemode_end()
+
     def options_handler(self, sock, cmd, opt):
         "Negotiate options"
+        if not self.prompted:
+            self.negotiate_time = time.time()
+        if self.trace is not None:
+            self.trace.command(cmd, cmd == SE and str(self.sbdataq) or opt)
+        # Replies go out together once the input received so far is handled.
+        self.hold_negotiation()
         if cmd == NOP:
             self.sendcommand(NOP)
-        elif cmd == WILL or cmd == WONT:
-            if self.WILLACK.has_key(opt):
-                self.sendcommand(self.WILLACK[opt], opt)
-            else:
-                self.sendcommand(DONT, opt)
-            if cmd == WILL and opt == TTYPE:
-                self.writecooked(IAC + SB + TTYPE + SEND + IAC + SE)
-        elif cmd == DO or cmd == DONT:
-            if self.DOACK.has_key(opt):
-                self.sendcommand(self.DOACK[opt], opt)
-            else:
-                self.sendcommand(WONT, opt)
-            if opt == ECHO:
-                self.DOECHO = (cmd == DO)
+        elif cmd == WILL:
+            self.negotiate(opt, False, self.willack(opt) == DO and Q_RECV_YES or Q_RECV_REFUSE)
+        elif cmd == WONT:
+            self.negotiate(opt, False, Q_RECV_NO)
+        elif cmd == DO:
+            self.negotiate(opt, True, self.doack(opt) == WILL and Q_RECV_YES or Q_RECV_REFUSE)
+        elif cmd == DONT:
+            self.negotiate(opt, True, Q_RECV_NO)
         elif cmd == SE:
             subreq = self.read_sb_data()
-            if subreq[0] == TTYPE and subreq[1] == IS:
+            if not subreq:
+                pass
+            elif subreq[0] == TTYPE and subreq[1:2] == IS:
                 try:
-                    self.setterm(subreq[2:])
+                    self.setterm(subreq[2:].tobytes())
                 except:
                     log.debug("Terminal type not known")
             elif subreq[0] == NAWS:
                 self.setnaws(subreq[1:])
+            elif subreq[0] == LINEMODE:
+                self.linemode_sb(subreq[1:].tobytes())
+            elif subreq[0] == NEW_ENVIRON:
+                self.setenviron(subreq[1:].tobytes())
+            elif subreq[0] == GMCP and self.gmcp:
+                self.gmcp_received(subreq[1:].tobytes())
+            elif subreq[0] == TLS and subreq[1:2] == FOLLOWS and self._tls_held is not None:
+                self.starttls()
         elif cmd == SB:
             pass
+        elif cmd == BRK and (self.reattached_to or self).relay_to is not None:
+            (self.reattached_to or self).relay_break()
+        elif cmd == IP:
+            # Same as the user typing Ctrl-C
+            self._inputcooker_store(chr(3))
+        elif cmd == xEOF:
+            # Same as the user typing Ctrl-D
+            self._inputcooker_store(chr(4))
         else:
-            log.debug("Unhandled option: %s %s" % (cmdtxt, opttxt, ))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Unhandled option: %s %s", CMDS.get(cmd, repr(cmd)), CMDS.get(opt, repr(opt)))
 
     def sendcommand(self, cmd, opt=None):
-        "Send a telnet command (IAC)"
-        if cmd in [DO, DONT]:
-            if not self.DOOPTS.has_key(opt):
-                self.DOOPTS[opt] = None
-            if (((cmd == DO) and (self.DOOPTS[opt] != True))
-            or ((cmd == DONT) and (self.DOOPTS[opt] != False))):
-                self.DOOPTS[opt] = (cmd == DO)
-                self.writecooked(IAC + cmd + opt)
-        elif cmd in [WILL, WONT]:
-            if not self.WILLOPTS.has_key(opt):
-                self.WILLOPTS[opt] = ''
-            if (((cmd == WILL) and (self.WILLOPTS[opt] != True))
-            or ((cmd == WONT) and (self.WILLOPTS[opt] != False))):
-                self.WILLOPTS[opt] = (cmd == WILL)
-                self.writecooked(IAC + cmd + opt)
+        """Send a telnet command (IAC).  DO, DONT, WILL and WONT ask for a
+        change of the option, sent only if the negotiation needs it."""
+        if cmd == DO or cmd == DONT:
+            self.negotiate(opt, False, cmd == DO and Q_ASK_YES or Q_ASK_NO)
+        elif cmd == WILL or cmd == WONT:
+            self.negotiate(opt, True, cmd == WILL and Q_ASK_YES or Q_ASK_NO)
         else:
-            self.writecooked(IAC + cmd)
+            self.writenegotiation(IAC + cmd)
+
+    def writesb(self, opt, data):
+        "Send a subnegotiation, escaping any IAC in the data"
+        self.writenegotiation(IAC + SB + opt + data.replace(IAC, IAC+IAC) + IAC + SE)
+
+    def hold_negotiation(self):
+        "Hold this task's negotiation commands until send_negotiation(), to send them in one write"
+        if self._negotiation is None:
+            self._negotiation = (self.current_task(), [])
+
+    def send_negotiation(self):
+        "Send the negotiation commands held by this task"
+        held = self._negotiation
+        if held is not None and held[0] is self.current_task():
+            self._negotiation = None
+            if held[1]:
+                self.writecooked(''.join(held[1]))
+
+    def writenegotiation(self, text):
+        "Send negotiation commands, or hold them if this task is holding them"
+        held = self._negotiation
+        if held is not None and held[0] is self.current_task():
+            held[1].append(text)
+        else:
+            self.writecooked(text)
+
+    def starttls(self):
+        "Switch the connection to TLS.  Raise socket.error if the handshake fails."
+        if self._tls_held is None:
+            self._tls_held = (self.current_task(), [])
+        try:
+            self.sock = self.tls_wrap(self.sock)
+        except socket.error, e:
+            log.info("TLS handshake with %s failed: %s", self.client_address[0], e)
+            self.count('tls_failures_total')
+            self._tls_held = None
+            raise
+        log.debug("TLS started")
+        self.count('tls_handshakes_total')
+        self.encrypted = True
+        self.tls_release()
+
+    def tls_release(self):
+        "Send the output other tasks wrote while TLS was starting, and let them write again"
+        held = self._tls_held[1]
+        while held:
+            text = ''.join(held)
+            del held[:]
+            TelnetHandlerBase.writecooked(self, text)
+        self._tls_held = None
+
+    def tls_handshake(self, sock):
+        "Complete the TLS handshake of a wrapped socket within TLS_TIMEOUT, return it"
+        sock.settimeout(self.TLS_TIMEOUT)
+        sock.do_handshake()
+        sock.settimeout(None)
+        return sock
+
+    def tls_wait(self):
+        "Wait at most TLS_TIMEOUT for START_TLS to finish.  Return True if the connection uses TLS."
+        deadline = time.time() + self.TLS_TIMEOUT
+        while not self.encrypted and not self.eof and time.time() < deadline:
+            state = self.option_states.get(TLS)
+            if self._tls_held is None and (state is None or state.him != Q_WANTYES):
+                break
+            self.sleep(0.05)
+        return self.encrypted
+
+    #abstractmethod
+    def tls_wrap(self, sock):
+        """Return the socket wrapped with tls_context, after the handshake"""
+        raise NotImplementedError("Please Implement the tls_wrap method")
+
+    def linemode_start(self):
+        "The client agreed to LINEMODE, ask it to edit lines locally"
+        self.writesb(LINEMODE, LM_MODE + chr(MODE_EDIT | MODE_TRAPSIG))
+        if self.LINEMODE_FORWARD:
+            mask = [0] * 32
+            for char in self.LINEMODE_FORWARD:
+                mask[ord(char) // 8] |= 128 >> (ord(char) % 8)
+            while mask and not mask[-1]:
+                mask.pop()
+            self.writesb(LINEMODE, DO + LM_FORWARDMASK + ''.join([chr(m) for m in mask]))
+
+    def linemode_end(self):
+        "Fall back to character at a time mode"
+        if not self.linemode:
+            return
+        log.debug("LINEMODE off")
+        self.linemode = False
+        self.sendcommand(WILL, ECHO)
+        if self.linebuf:
+            self.inputcooker_store_queue([self.linebuf])
+            self.linebuf = ''
+
+    def linemode_sb(self, data):
+        "Handle a LINEMODE subnegotiation"
+        if not data:
+            return
+        if data[0] == LM_MODE and len(data) > 1:
+            mode = ord(data[1])
+            if not mode & MODE_ACK:
+                # The client proposes a mode, accept it.
+                self.writesb(LINEMODE, LM_MODE + chr(mode | MODE_ACK))
+            if mode & MODE_EDIT:
+                if not self.linemode:
+                    log.debug("LINEMODE on, client edits lines")
+                    self.linemode = True
+                    # The client echoes locally when the server won't.
+                    self.sendcommand(WONT, ECHO)
+            else:
+                self.linemode_end()
+        elif data[0] == LM_SLC:
+            # Agree to the client's special characters, acknowledging each one.
+            reply = []
+            for idx in range(1, len(data) - 2, 3):
+                func, flags, value = data[idx:idx+3]
+                if ord(flags) & SLC_ACK:
+                    continue
+                self.own('linemode_slc')[func] = (ord(flags), value)
+                if ord(flags) & SLC_LEVELBITS != SLC_NOSUPPORT:
+                    reply.append(func + chr(ord(flags) | SLC_ACK) + value)
+            if reply:
+                self.writesb(LINEMODE, LM_SLC + ''.join(reply))
+        elif data[0] in (WILL, WONT) and data[1:2] == LM_FORWARDMASK:
+            log.debug("LINEMODE forward mask %s", CMDS[data[0]])
+
+    def setenviron(self, data):
+        "Store the variables of a NEW_ENVIRON IS or INFO subnegotiation in ENV"
+        if data[:1] not in (IS, INFO):
+            return
+        name = None
+        value = None
+        current = None
+        idx = 1
+        while idx <= len(data):
+            char = data[idx:idx+1]
+            if char in (ENV_VAR, ENV_USERVAR, ''):
+                if name is not None:
+                    self.own('ENV')[''.join(name)] = value is not None and ''.join(value) or ''
+                name = current = []
+                value = None
+            elif char == ENV_VALUE:
+                value = current = []
+            else:
+                if char == ENV_ESC:
+                    idx += 1
+                    char = data[idx:idx+1]
+                if current is not None:
+                    current.append(char)
+            idx += 1
+        log.debug("Environment: %r", self.ENV)
+        if self.BATCH_ENV and self.ENV.get(self.BATCH_ENV, '').lower() in ('1', 'yes', 'true', 'on'):
+            log.debug("Client selected batch mode")
+            self.batch = True
+
+    def gmcp_received(self, data):
+        "Handle a GMCP message: a package.message name, optionally followed by JSON data"
+        name, _, payload = data.partition(' ')
+        try:
+            value = payload.strip() and json.loads(payload) or None
+        except ValueError:
+            log.debug("Bad GMCP data for %s: %r", name, payload)
+            return
+        self.gmcp_message(name, value)
+
+    def gmcp_message(self, name, value):
+        "Act on a GMCP message from the client.  Override to handle more packages."
+        if name == 'Command.Run':
+            if not isinstance(value, dict) or not isinstance(value.get('command'), basestring):
+                self.gmcp_send('Command.Result', {'id': None, 'ok': False, 'error': 'Missing command'})
+                return
+            request_id = value.get('id')
+            if not self.logged_in:
+                # Refuse before a task is started for it.
+                self.gmcp_send('Command.Result', {'id': request_id, 'ok': False, 'error': 'Not logged in'})
+                return
+            # Run it alongside the interactive session, the input cooker must not wait.
+            # One task per session runs the commands in turn.
+            start = full = False
+            _shared_lock.acquire()
+            try:
+                if self._gmcp_queue is None:
+                    self._gmcp_queue = []
+                    start = True
+                full = len(self._gmcp_queue) >= self.GMCP_MAX_QUEUED
+                if not full:
+                    self._gmcp_queue.append((request_id, value['command'], value.get('params') or []))
+            finally:
+                _shared_lock.release()
+            if full:
+                self.gmcp_send('Command.Result', {'id': request_id, 'ok': False, 'error': 'Too many commands'})
+            elif start:
+                self.spawn(self.run_gmcp_queue)
+        else:
+            log.debug("GMCP message %s ignored", name)
+
+    def gmcp_send(self, name, value):
+        "Send a GMCP message with JSON data"
+        self.writesb(GMCP, '%s %s' % (name, json.dumps(value, default=str)))
 
     def read_sb_data(self):
         """Return any data available in the SB ... SE queue.
 
-        Return '' if no SB ... SE available. Should only be called
-        after seeing a SB or SE command. When a new SB command is
-        found, old unread SB data will be discarded. Don't block.
+        Return an empty view if no SB ... SE available, or if it was
+        too long. Should only be called after seeing a SB or SE
+        command. When a new SB command is found, old unread SB data
+        will be discarded. Don't block.
 
+        The data is returned as a memoryview, not copied.  Use
+        tobytes() on it (or a slice of it) to get a string.
         """
         buf = self.sbdataq
-        self.sbdataq = ''
-        return buf
+        self.sbdataq = bytearray()
+        return memoryview(buf)
+
+    def _sb_store(self, data):
+        """Add to the subnegotiation data, discarding it if it grows too long"""
+        if not self.sblimit:
+            return
+        if not self.sbdataq:
+            # The first byte is the option, which sets the limit.
+            self.sblimit = self.SB_MAXLEN.get(data[0], self.SB_MAXLEN_DEFAULT)
+        if len(self.sbdataq) + len(data) > self.sblimit:
+            log.debug("Discarding %s subnegotiation longer than %d bytes",
+                      CMDS.get(self.sbdataq and chr(self.sbdataq[0]) or data[0], 'unknown'), self.sblimit)
+            self.sbdataq = bytearray()
+            self.sblimit = 0
+            return
+        self.sbdataq.extend(data)
 
 # ---------------------------- Input Functions -----------------------------
 
     def _readline_do_echo(self, echo):
         """Determine if we should echo or not"""
+        if self.linemode:
+            # The client has already echoed the line
+            return False
         return echo == True or (echo == None and self.DOECHO == True)
 
     def _readline_echo(self, char, echo):
@@ -625,11 +1709,41 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         """Deal properly with inserted chars in a line."""
         if not self._readline_do_echo(echo):
             return
-        # Write out the remainder of the line
-        self.write(char + ''.join(line[insptr:]))
-        # Cursor Left to the current insert point
-        char_count = len(line) - insptr
-        self.write(self.CODES['CSRLEFT'] * char_count)
+        if self.CODES['INS_N']:
+            # Let the terminal open up space for the new chars
+            self.write(curses.tparm(self.CODES['INS_N'], len(char)) + char)
+        elif self.CODES['INS'] and len(char) == 1:
+            self.write(self.CODES['INS'] + char)
+        else:
+            # Write out the remainder of the line
+            # then Cursor Left to the current insert point
+            self.write(char + ''.join(line[insptr:]) + self._cursor_left(len(line) - insptr))
+    
+    def _cursor_left(self, count):
+        """Return the codes to move the cursor count spaces left"""
+        if count <= 0:
+            return ''
+        if count > 1 and self.CODES['CSRLEFT_N']:
+            return curses.tparm(self.CODES['CSRLEFT_N'], count)
+        return self.CODES['CSRLEFT'] * count
+    
+    def _readline_redraw(self, old, insptr, new, echo):
+        """Replace the displayed line old (cursor at insptr) with new (cursor at its end).
+        Only the chars after the common prefix of the two lines are written."""
+        common = 0
+        for (a, b) in zip(old, new):
+            if a != b:
+                break
+            common = common + 1
+        if insptr > common:
+            codes = self._cursor_left(insptr - common)
+        else:
+            # Moving right, rewrite the chars that are already there.
+            codes = ''.join(old[insptr:common])
+        codes = codes + ''.join(new[common:])
+        if len(old) > len(new):
+            codes = codes + self.CODES['DEOL']
+        self._readline_echo(codes, echo)
     
     _current_line = ''
     _current_prompt = ''
@@ -653,18 +1767,33 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
             self._readline_echo(BELL, True)
             return theNULL     
     
-    def readline(self, echo=None, prompt='', use_history=True):
+    def readline(self, echo=None, prompt='', use_history=True, use_completion=False):
         """Return a line of text, including the terminating LF
            If echo is true always echo, if echo is false never echo
            If echo is None follow the negotiated setting.
            prompt is the current prompt to write (and rewrite if needed)
            use_history controls if this current line uses (and adds to) the command history.
+           use_completion controls if TAB completes command names and parameters.
         """
-        
+        if not self.prompted:
+            self.prompted = True
+            self.observe('first_prompt_seconds', time.time() - self.connect_time)
+            if self.negotiate_time is not None:
+                self.observe('negotiation_seconds', self.negotiate_time - self.connect_time)
+        if self.batch:
+            line = self._readline_batch()
+            if self.recording is not None and echo is not False:
+                self.recording.input(line + chr(10))
+            return line
         line = []
         insptr = 0
         ansi = 0
         histptr = len(self.history)
+        if self._completions:
+            del self._completions
+        if self.pager_rows is not None:
+            # The command is asking for input, the user has seen the output so far.
+            self.pager_rows = 0
             
         if self.DOECHO:
             self.write(prompt)
@@ -674,98 +1803,235 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         
         self._current_line = ''
         
-        while True:
-            c = self.getc(block=True)
-            c = self.ansi_to_curses(c)
-            if c == theNULL:
-                continue
-            
-            elif c == curses.KEY_LEFT:
-                if insptr > 0:
-                    insptr = insptr - 1
-                    self._readline_echo(self.CODES['CSRLEFT'], echo)
-                else:
-                    self._readline_echo(BELL, echo)
-                continue
-            elif c == curses.KEY_RIGHT:
-                if insptr < len(line):
-                    insptr = insptr + 1
-                    self._readline_echo(self.CODES['CSRRIGHT'], echo)
+        hide = (self.linemode and echo is False
+                and self.option_state(ECHO).us not in (Q_YES, Q_WANTYES))
+        if hide:
+            # Stop the client from echoing locally while reading this line.
+            self.sendcommand(WILL, ECHO)
+        try:
+            pending = None
+            while True:
+                if pending is None:
+                    c = self.getc(block=True)
                 else:
-                    self._readline_echo(BELL, echo)
-                continue
-            elif c == curses.KEY_UP or c == curses.KEY_DOWN:
-                if not use_history:
-                    self._readline_echo(BELL, echo)
+                    c, pending = pending, None
+                if isinstance(c, str) and len(c) > 1:
+                    # A line, already edited by a LINEMODE client.  Process the last char as usual.
+                    line[insptr:insptr] = c[:-1]
+                    insptr = insptr + len(c) - 1
+                    c = c[-1]
+                c = self.ansi_to_curses(c)
+                if c == theNULL:
+                    continue
+            
+                elif c == curses.KEY_LEFT:
+                    if insptr > 0:
+                        insptr = insptr - 1
+                        self._readline_echo(self.CODES['CSRLEFT'], echo)
+                    else:
+                        self._readline_echo(BELL, echo)
                     continue
-                if c == curses.KEY_UP:
-                    if histptr > 0:
-                        histptr = histptr - 1
+                elif c == curses.KEY_RIGHT:
+                    if insptr < len(line):
+                        insptr = insptr + 1
+                        self._readline_echo(self.CODES['CSRRIGHT'], echo)
                     else:
                         self._readline_echo(BELL, echo)
+                    continue
+                elif c == curses.KEY_UP or c == curses.KEY_DOWN:
+                    if not use_history:
+                        self._readline_echo(BELL, echo)
                         continue
-                elif c == curses.KEY_DOWN:
+                    if c == curses.KEY_UP:
+                        if histptr > 0:
+                            histptr = histptr - 1
+                        else:
+                            self._readline_echo(BELL, echo)
+                            continue
+                    elif c == curses.KEY_DOWN:
+                        if histptr < len(self.history):
+                            histptr = histptr + 1
+                        else:
+                            self._readline_echo(BELL, echo)
+                            continue
+                    new = []
                     if histptr < len(self.history):
-                        histptr = histptr + 1
+                        new.extend(self.history[histptr])
+                    self._readline_redraw(line, insptr, new, echo)
+                    line = new
+                    insptr = len(line)
+                    continue
+                elif c == chr(3):
+                    self.interrupted = False
+                    self.pager_rows = None
+                    self._readline_echo('\n' + curses.ascii.unctrl(c) + ' ABORT\n', echo)
+                    self._current_prompt = self._current_line = ''
+                    return ''
+                elif c == chr(4):
+                    if len(line) > 0:
+                        self._readline_echo('\n' + curses.ascii.unctrl(c) + ' ABORT (QUIT)\n', echo)
+                        self._current_prompt = self._current_line = ''
+                        return ''
+                    self._readline_echo('\n' + curses.ascii.unctrl(c) + ' QUIT\n', echo)
+                    self._current_prompt = self._current_line = ''
+                    return 'QUIT'
+                elif c == chr(18) and use_history and self._readline_do_echo(echo):
+                    line, pending = self._readline_search(line, echo)
+                    insptr = len(line)
+                    self._current_line = line
+                    continue
+                elif c == chr(10):
+                    self._readline_echo(c, echo)
+                    result = ''.join(line)
+                    if use_history:
+                        self.history.append(result)
+                    if echo is False:
+                        if prompt:
+                            self.write( chr(10) )
+                        log.debug('readline: %s(hidden text)', prompt)
+                    else:
+                        if self.recording is not None:
+                            self.recording.input(result + chr(10))
+                        if log.isEnabledFor(logging.DEBUG):
+                            log.debug('readline: %s%r', prompt, result)
+                    self._current_prompt = self._current_line = ''
+                    return result
+                elif c == curses.KEY_BACKSPACE or c == chr(127) or c == chr(8):
+                    if insptr > 0:
+                        self._readline_echo(self.CODES['CSRLEFT'] + self.CODES['DEL'], echo)
+                        insptr = insptr - 1
+                        del line[insptr]
+                    else:
+                        self._readline_echo(BELL, echo)
+                    continue
+                elif c == curses.KEY_DC:
+                    if insptr < len(line):
+                        self._readline_echo(self.CODES['DEL'], echo)
+                        del line[insptr]
                     else:
                         self._readline_echo(BELL, echo)
+                    continue
+                elif c == chr(9) and use_completion:
+                    c = self._readline_complete(line, insptr, echo)
+                    if not c:
                         continue
-                line = []
-                if histptr < len(self.history):
-                    line.extend(self.history[histptr])
-                for char in range(insptr):
-                    self._readline_echo(self.CODES['CSRLEFT'], echo)
-                self._readline_echo(self.CODES['DEOL'], echo)
-                self._readline_echo(''.join(line), echo)
-                insptr = len(line)
-                continue
-            elif c == chr(3):
-                self._readline_echo('\n' + curses.ascii.unctrl(c) + ' ABORT\n', echo)
+                    if len(line) > insptr:
+                        self._readline_insert(c, echo, insptr, line)
+                    else:
+                        self._readline_echo(c, echo)
+                else:
+                    if ord(c) < 32:
+                        c = curses.ascii.unctrl(c)
+                    if len(line) > insptr:
+                        self._readline_insert(c, echo, insptr, line)
+                    else:
+                        self._readline_echo(c, echo)
+                line[insptr:insptr] = c
+                insptr = insptr + len(c)
+                if self._readline_do_echo(echo):
+                    self._current_line = line
+        finally:
+            if hide:
+                self.sendcommand(WONT, ECHO)
+    
+    def _readline_batch(self):
+        """Return the next line of scripted input, without echo, prompt, editing or history."""
+        line = ''
+        while True:
+            c = self.getc(block=True)
+            if c == chr(3):
                 return ''
-            elif c == chr(4):
-                if len(line) > 0:
-                    self._readline_echo('\n' + curses.ascii.unctrl(c) + ' ABORT (QUIT)\n', echo)
-                    return ''
-                self._readline_echo('\n' + curses.ascii.unctrl(c) + ' QUIT\n', echo)
+            if c == chr(4) and not line:
                 return 'QUIT'
-            elif c == chr(10):
-                self._readline_echo(c, echo)
-                result = ''.join(line)
-                if use_history:
-                    self.history.append(result)
-                if echo is False:
-                    if prompt:
-                        self.write( chr(10) )
-                    log.debug('readline: %s(hidden text)', prompt)
-                else:
-                    log.debug('readline: %s%r', prompt, result)
-                return result
-            elif c == curses.KEY_BACKSPACE or c == chr(127) or c == chr(8):
-                if insptr > 0:
-                    self._readline_echo(self.CODES['CSRLEFT'] + self.CODES['DEL'], echo)
-                    insptr = insptr - 1
-                    del line[insptr]
-                else:
-                    self._readline_echo(BELL, echo)
+            if not isinstance(c, str):
+                # A special key, scripts don't edit lines.
                 continue
-            elif c == curses.KEY_DC:
-                if insptr < len(line):
-                    self._readline_echo(self.CODES['DEL'], echo)
-                    del line[insptr]
-                else:
-                    self._readline_echo(BELL, echo)
+            line = line + c
+            if line.endswith(chr(10)):
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('readline (batch): %r', line)
+                return line[:-1]
+
+    def _readline_search(self, line, echo):
+        """Handle Ctrl-R, reverse incremental search of the history.
+        Return the chosen line and the key that ended the search (None if cancelled)."""
+        query = ''
+        found = []
+        pos = len(self.history)
+        while True:
+            self._readline_echo('\r(reverse-i-search)`%s\': %s' % (query, ''.join(found)) + self.CODES['DEOL'], echo)
+            c = self.ansi_to_curses(self.getc(block=True))
+            if c == chr(18):
+                # Look further back for the same text.
+                start = pos
+            elif c == curses.KEY_BACKSPACE or c == chr(127) or c == chr(8):
+                query = query[:-1]
+                start = len(self.history)
+            elif isinstance(c, str) and len(c) == 1 and ' ' <= c < chr(127):
+                query = query + c
+                start = pos + 1
+            elif c == chr(7) or c == chr(3):
+                # Cancelled, put the original line back.
+                self._readline_echo('\r' + self._current_prompt + ''.join(line) + self.CODES['DEOL'], echo)
+                return line, None
+            else:
+                self._readline_echo('\r' + self._current_prompt + ''.join(found) + self.CODES['DEOL'], echo)
+                return found, c
+            if not query:
+                pos = len(self.history)
+                found = []
                 continue
+            idx = self.history.search(query, start)
+            if idx >= 0:
+                pos = idx
+                found = list(self.history[idx])
             else:
-                if ord(c) < 32:
-                    c = curses.ascii.unctrl(c)
-                if len(line) > insptr:
-                    self._readline_insert(c, echo, insptr, line)
-                else:
-                    self._readline_echo(c, echo)
-            line[insptr:insptr] = c
-            insptr = insptr + len(c)
-            if self._readline_do_echo(echo):
-                self._current_line = line
+                self._readline_echo(BELL, echo)
+    
+    def _readline_complete(self, line, insptr, echo):
+        """Handle TAB.  Return the text to insert, list the choices if there are several."""
+        text = ''.join(line[:insptr])
+        words = text.split()
+        if words and text[-1] not in ' \t':
+            current = words.pop()
+        else:
+            current = ''
+        key = (tuple(words), current)
+        if key not in self._completions:
+            self.own('_completions')[key] = self.complete(words, current)
+        candidates = self._completions[key]
+        if not candidates:
+            self._readline_echo(BELL, echo)
+            return ''
+        common = os.path.commonprefix(candidates)
+        if len(candidates) == 1:
+            return common[len(current):] + ' '
+        if len(common) > len(current):
+            return common[len(current):]
+        # Nothing more to add, show the choices and rebuild the line.
+        self._readline_echo('\n' + '  '.join(candidates) + '\n' + self._current_prompt + ''.join(line), echo)
+        self._readline_echo(self._cursor_left(len(line) - insptr), echo)
+        return ''
+    
+    def complete(self, words, text):
+        """Return the possible completions of text, following the already entered words.
+        Command names are completed from the command trie, parameters by the command's completer."""
+        if not words:
+            names = [name for name in self._command_trie.complete(text.upper()) if name in self.COMMANDS]
+            if text == text.lower():
+                names = [name.lower() for name in names]
+            return names
+        matches = self.match_command(words[0].upper())
+        if len(matches) != 1:
+            return []
+        completer = getattr(self.COMMANDS[matches[0]], 'completer', None)
+        if completer is None:
+            return []
+        if isinstance(completer, basestring):
+            candidates = getattr(self, completer)(words[1:], text)
+        else:
+            candidates = completer(self, words[1:], text)
+        return sorted([c for c in candidates if c.startswith(text)])
     
     #abstractmethod
     def getc(self, block=True):
@@ -781,29 +2047,280 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         
     def writeerror(self, text):
         """Write out any error messages.  Easy to override with ANSI codes."""
+        self.command_failed = True
         self.writeline(text)
 
+    def writeresult(self, result):
+        """Write out the data object returned by a command.  Easy to override."""
+        if isinstance(result, dict):
+            keys = sorted(result.keys())
+            width = max([len(str(key)) for key in keys] + [0])
+            for key in keys:
+                self.writeresponse('%-*s : %s' % (width, key, result[key]))
+        elif isinstance(result, (list, tuple)):
+            for item in result:
+                self.writeresponse(str(item))
+        else:
+            self.writeresponse(str(result))
+
     def writeline(self, text):
         """Send a packet with line ending."""
-        log.debug('writing line %r' % text)
-        self.write(text+chr(10))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('writing line %r', text)
+        if self._captures:
+            capture = self._captures.get(self.current_task())
+            if capture is not None:
+                capture.extend(str(text).split(chr(10)))
+                return
+        job = self.jobs and self.current_job()
+        if job:
+            self._writeline_job(job, text)
+        elif self.output_filter is not None:
+            self._writeline_filtered(text)
+        elif self.pager_rows is not None:
+            self._writeline_paged(text)
+        elif self.batch:
+            self._writeline_batch(text)
+        else:
+            self.write(text+chr(10))
+
+    def _writeline_filtered(self, text):
+        """Pass each line through the output filters.  Raise OutputAborted when no more is wanted."""
+        chain = self.output_filter
+        if chain.exhausted:
+            raise OutputAborted()
+        for line in str(text).split(chr(10)):
+            for result in chain.feed(line):
+                if self.pager_rows is not None:
+                    self._writeline_paged(result)
+                elif self.batch:
+                    self._writeline_batch(result)
+                else:
+                    self.write(result+chr(10))
+        if chain.exhausted:
+            raise OutputAborted()
+
+    def _writeline_batch(self, text):
+        """Write lines in batch mode, doubling a leading @ so no line looks like the end of the output."""
+        lines = []
+        for line in str(text).split(chr(10)):
+            if line[:1] == '@':
+                line = '@' + line
+            lines.append(line + chr(10))
+        self.write(''.join(lines))
+
+    def _writeline_job(self, job, text):
+        """Deliver a background job's output as messages.  Raise OutputAborted once it is killed."""
+        if job.killed:
+            raise OutputAborted()
+        lines = str(text).split(chr(10))
+        chain = job.output_filter
+        if chain is not None:
+            if chain.exhausted:
+                raise OutputAborted()
+            lines = [result for line in lines for result in chain.feed(line)]
+        for line in lines:
+            if job.foreground:
+                self.write(line+chr(10))
+            else:
+                self.writemessage('[%d] %s' % (job.number, line))
+        if chain is not None and chain.exhausted:
+            raise OutputAborted()
+
+    def _writeline_paged(self, text):
+        """Write lines, pausing with PAGER_PROMPT each time the screen fills up.
+        Raise OutputAborted if the user quits."""
+        for line in str(text).split(chr(10)):
+            rows = max(1, (len(line) + self.WIDTH - 1) // self.WIDTH)
+            if self.pager_rows + rows >= self.HEIGHT:
+                self._pager_pause()
+            self.pager_rows += rows
+            self.write(line+chr(10))
+
+    def _pager_pause(self):
+        """Wait for the user to ask for more output"""
+        self.write(self.PAGER_PROMPT)
+        c = self.getc(block=True)
+        self.write(chr(13) + (self.CODES['DEOL'] or ' ' * len(self.PAGER_PROMPT) + chr(13)))
+        if c in ('q', 'Q', chr(3)):
+            self.interrupted = False
+            self.pager_rows = None
+            raise OutputAborted()
+        if c in (chr(10), chr(13)):
+            # Just one more line.
+            self.pager_rows = self.HEIGHT - 2
+        else:
+            self.pager_rows = 0
+
+    def writestream(self, lines):
+        """Write each line (or chunk ending in a line feed) produced by the iterator.
+        The iterator is only advanced as fast as the client accepts the output,
+        and is closed early if the user presses Ctrl-C or disconnects."""
+        try:
+            for line in lines:
+                if self.interrupted or self.eof:
+                    break
+                if line.endswith(chr(10)):
+                    line = line[:-1]
+                self.writeline(line)
+            if self.interrupted:
+                self.write('^C' + chr(10))
+                # Like a terminal, drop any type-ahead up to the Ctrl-C.
+                while self.getc(block=False) not in ('', chr(3)):
+                    pass
+                self.interrupted = False
+        finally:
+            close = getattr(lines, 'close', None)
+            if close is not None:
+                close()
 
     def writemessage(self, text):
         """Write out an asynchronous message, then reconstruct the prompt and entered text."""
-        log.debug('writing message %r', text)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('writing message %r', text)
+        if not (self._current_prompt or self._current_line):
+            # Not reading a line, nothing to reconstruct.
+            self.write(text+chr(10))
+            return
         self.write(chr(10)+text+chr(10))
         self.write(self._current_prompt+''.join(self._current_line))
 
     def write(self, text):
         """Send a packet to the socket. This function cooks output."""
         text = str(text)    # eliminate any unicode or other snigglets
-        text = text.replace(IAC, IAC+IAC)
         text = text.replace(chr(10), chr(13)+chr(10))
+        if self.recording is not None:
+            self.recording.output(text)
+        text = text.replace(IAC, IAC+IAC)
         self.writecooked(text)
 
     def writecooked(self, text):
         """Put data directly into the output queue (bypass output cooker)"""
-        self.sock.sendall(text)
+        held = self._tls_held
+        if held is not None and held[0] is not self.current_task():
+            # TLS is starting, this goes out once it is up.
+            held[1].append(text)
+            return
+        buffer = self.output_buffer
+        if buffer is not None and buffer.write(text):
+            return
+        try:
+            self.sock.sendall(text)
+            if self.trace is not None:
+                self.trace.sent(text)
+            self.count('send_calls_total')
+            self.count('bytes_out_total', len(text))
+        except socket.error:
+            if buffer is not None or not self.detach():
+                raise
+            self.output_buffer.write(text)
+
+# ---------------------------------- Relay ---------------------------------
+    def relay(self, target, escape=None, binary=True):
+        """Connect the client to target, for a console server: a socket, or
+        a file or file descriptor such as a serial port or the master of a
+        pty.  Data passes both ways in chunks of up to RELAY_CHUNK bytes,
+        until the target closes, the connection is lost or the client
+        types the escape character.  With binary, both directions are
+        asked to use the BINARY option.  Return True if the target closed."""
+        if hasattr(target, 'recv_into'):
+            fileno = target.fileno()
+            readinto = target.recv_into
+        else:
+            if hasattr(target, 'fileno'):
+                fileno = target.fileno()
+            else:
+                fileno = target
+            readinto = io.FileIO(fileno, 'r', closefd=False).readinto
+        self._relay_escape = escape
+        self._relay_fd = fileno
+        self._relay_cr = False
+        self.relay_to = target
+        if binary:
+            self.sendcommand(WILL, BINARY)
+            self.sendcommand(DO, BINARY)
+        if self.window_known:
+            self.relay_resize(self.WIDTH, self.HEIGHT)
+        # Output that is kept (traced, recorded, buffered while detached)
+        # needs its own copy, anything else is sent straight from the buffer.
+        keep = self.trace is not None or self.recording is not None or self.detached_sessions is not None
+        buf = bytearray(self.RELAY_CHUNK)
+        view = memoryview(buf)
+        closed = False
+        try:
+            while self.relay_to is target and not self.eof:
+                if not self.wait_readable(fileno, self.RELAY_POLL):
+                    continue
+                try:
+                    count = readinto(view)
+                except (IOError, OSError, socket.error), e:
+                    if e.errno in (errno.EINTR, errno.EAGAIN):
+                        continue
+                    # A pty's master reads EIO once the slave side is closed.
+                    log.debug("Relay target failed: %s", e)
+                    count = 0
+                if not count:
+                    closed = True
+                    break
+                if buf.find(IAC, 0, count) >= 0:
+                    text = view[:count].tobytes()
+                    self.writecooked(text.replace(IAC, IAC + IAC))
+                elif keep:
+                    text = view[:count].tobytes()
+                    self.writecooked(text)
+                else:
+                    text = None
+                    self.writecooked(view[:count])
+                if self.recording is not None:
+                    self.recording.output(text)
+        finally:
+            self.relay_to = None
+            self._relay_fd = None
+            if binary and not self.eof:
+                self.sendcommand(WONT, BINARY)
+                self.sendcommand(DONT, BINARY)
+        return closed
+
+    def relay_input(self, text):
+        """Pass input from the client on to the relay target.  Return the
+        input following the escape character, which ends the relay."""
+        target = self.relay_to
+        if target is None:
+            # The relay has just ended, the input is for the session.
+            return text
+        rest = ''
+        if self._relay_escape is not None and self._relay_escape in text:
+            (text, rest) = text.split(self._relay_escape, 1)
+            self.relay_to = None
+        if not self.option_active(BINARY):
+            # Outside of BINARY, the client sends a carriage return as CR NUL.
+            if self._relay_cr and text[:1] == theNULL:
+                text = text[1:]
+            if text:
+                self._relay_cr = text[-1] == chr(13)
+            text = text.replace(chr(13) + theNULL, chr(13))
+        try:
+            if hasattr(target, 'sendall'):
+                target.sendall(text)
+            else:
+                while text:
+                    text = text[os.write(self._relay_fd, text):]
+        except (IOError, OSError, socket.error), e:
+            log.debug("Relay target failed: %s", e)
+            self.relay_to = None
+        return rest
+
+    def relay_break(self):
+        """The client sent BREAK while relaying.  Sends a break on a serial
+        port, override for other targets."""
+        if self._relay_fd is not None and not hasattr(self.relay_to, 'sendall') and os.isatty(self._relay_fd):
+            termios.tcsendbreak(self._relay_fd, 0)
+
+    def relay_resize(self, width, height):
+        """The client's window size while relaying.  Sets the size of a
+        pty, override for other targets."""
+        if self._relay_fd is not None and not hasattr(self.relay_to, 'sendall') and os.isatty(self._relay_fd):
+            fcntl.ioctl(self._relay_fd, termios.TIOCSWINSZ, struct.pack('HHHH', height, width, 0, 0))
 
 # ------------------------------- Input Cooker -----------------------------
     def _inputcooker_getc(self, block=True):
@@ -814,15 +2331,42 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
             ret = self.rawq[0]
             self.rawq = self.rawq[1:]
             return ret
-        if not block:
-            if not self.inputcooker_socket_ready():
-                return ''
-        ret = self.sock.recv(20)
+        if not block and not (self.encrypted and self.sock.pending()) and not self.inputcooker_socket_ready():
+            if self._negotiation is not None:
+                self.send_negotiation()
+            return ''
+        self._inputcooker_recv()
+        return self._inputcooker_getc(block)
+
+    def _inputcooker_recv(self):
+        """Read from the socket onto the raw queue, blocking.  Raise
+        EOFError on end of stream. SHOULD ONLY BE CALLED FROM THE INPUT
+        COOKER."""
+        if self._negotiation is not None:
+            # All input so far is handled, answer its negotiation at once.
+            self.send_negotiation()
+        self.count_cooked()
+        size = (self.batch or self.sb) and 4096 or 20
+        if (self.reattached_to or self).relay_to is not None:
+            size = self.RELAY_CHUNK
+        if self._tls_held is not None:
+            # Don't read past START_TLS FOLLOWS into the client's handshake.
+            size = 1
+        ret = self.sock.recv(size)
+        self.count('recv_calls_total')
+        self.count('bytes_in_total', len(ret))
+        if self.trace is not None and ret:
+            self.trace.received(ret)
         self.eof = not(ret)
         self.rawq = self.rawq + ret
         if self.eof:
             raise EOFError
-        return self._inputcooker_getc(block)
+
+    #abstractmethod
+    def wait_readable(self, fileno, timeout):
+        """Wait at most timeout seconds for the file descriptor to be
+        readable, without blocking other sessions.  Return True if it is."""
+        raise NotImplementedError("Please Implement the wait_readable method")
 
     #abstractmethod
     def inputcooker_socket_ready(self):
@@ -838,10 +2382,37 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
 
     def _inputcooker_store(self, char):
         """Put the cooked data in the correct queue"""
+        session = self.reattached_to or self
         if self.sb:
-            self.sbdataq = self.sbdataq + char
+            self._sb_store(char)
+            return
+        if session.relay_to is not None:
+            session.relay_input(char)
+            return
+        self.counters['cooked_chars_total'] = self.counters.get('cooked_chars_total', 0) + 1
+        if (self.linemode or self.batch) and isinstance(char, str) and char != chr(3):
+            # Pass whole lines (or up to a forwarded char) on as a single item.
+            self.linebuf = self.linebuf + char
+            if char == chr(10) or char in self.LINEMODE_FORWARD:
+                session.inputcooker_store_queue([self.linebuf])
+                self.linebuf = ''
         else:
-            self.inputcooker_store_queue(char)
+            if self.linebuf:
+                session.inputcooker_store_queue([self.linebuf])
+                self.linebuf = ''
+            session.inputcooker_store_queue(char)
+            if char == chr(3):
+                # Let a streaming command know it should stop.
+                session.interrupted = True
+
+    def _inputcooker_store_text(self, text):
+        """Queue each complete line of plain text, keep the rest for later"""
+        self.counters['cooked_chars_total'] = self.counters.get('cooked_chars_total', 0) + len(text)
+        lines = (self.linebuf + text).split(chr(10))
+        self.linebuf = lines.pop()
+        if lines:
+            session = self.reattached_to or self
+            session.inputcooker_store_queue([line + chr(10) for line in lines])
 
     #abstractmethod
     def inputcooker_store_queue(self, char):
@@ -856,6 +2427,34 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         """
         try:
             while True:
+                session = self.reattached_to or self
+                if session.relay_to is not None and not self.iacseq and not self.sb:
+                    # Pass on everything up to the next telnet command in one piece.
+                    if not self.rawq:
+                        self._inputcooker_recv()
+                    end = self.rawq.find(IAC)
+                    while end >= 0 and self.rawq[end + 1:end + 2] == IAC:
+                        end = self.rawq.find(IAC, end + 2)
+                    if end:
+                        if end < 0:
+                            end = len(self.rawq)
+                        text = self.rawq[:end].replace(IAC + IAC, IAC)
+                        self.rawq = session.relay_input(text) + self.rawq[end:]
+                        continue
+                if self.sb and not self.iacseq and self.rawq:
+                    # Take subnegotiation data in one piece, not char by char.
+                    text = SB_TEXT.match(self.rawq).group()
+                    if text:
+                        self.rawq = self.rawq[len(text):]
+                        self._sb_store(text)
+                        continue
+                if self.batch and not self.iacseq and not self.sb and self.rawq:
+                    # Pass on plain text a line at a time, not char by char.
+                    text = BATCH_TEXT.match(self.rawq).group()
+                    if text:
+                        self.rawq = self.rawq[len(text):]
+                        self._inputcooker_store_text(text)
+                        continue
                 c = self._inputcooker_getc()
                 if not self.iacseq:
                     if c == IAC:
@@ -870,7 +2469,7 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
                         else:
                             self._inputcooker_ungetc(c2)
                             c = chr(10)
-                    elif c in [x[0] for x in self.ESCSEQ.keys()]:
+                    elif c in self.ESCSEQ_START:
                         'Looks like the begining of a key sequence'
                         codes = c
                         for keyseq in self.ESCSEQ.keys():
@@ -897,7 +2496,8 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
                     else:
                         if c == SB: # SB ... SE start.
                             self.sb = 1
-                            self.sbdataq = ''
+                            self.sbdataq = bytearray()
+                            self.sblimit = self.SB_MAXLEN_DEFAULT
                         elif c == SE: # SB ... SE end.
                             self.sb = 0
                         # Callback is supposed to look into
@@ -910,6 +2510,7 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
                         self.options_handler(self.sock, cmd, c)
         except (EOFError, socket.error):
             pass
+        self.connection_lost()
 
 # ------------------------------- Basic Commands ---------------------------
 
@@ -926,7 +2527,9 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
         """
         if params:
             cmd = params[0].upper()
-            if self.COMMANDS.has_key(cmd):
+            matches = self.match_command(cmd)
+            if len(matches) == 1:
+                cmd = matches[0]
                 method = self.COMMANDS[cmd]
                 doc = method.__doc__.split("\n")
                 docp = doc[0].strip()
@@ -941,6 +2544,8 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
                     )
                 )
                 return
+            elif matches:
+                self.writeline("Ambiguous command '%s' (%s)" % (cmd, ', '.join(matches)))
             else:
                 self.writeline("Command '%s' not known" % cmd)
         else:
@@ -978,17 +2583,474 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
     cmdEXIT.aliases = ['QUIT', 'BYE', 'LOGOUT']
 
     def cmdHISTORY(self, params):
-        """
+        """[<count>]
         Display the command history
+        Shows the most recent commands, 20 unless a count is given.
+        Ctrl-R searches backwards through the history.
         """
-        cnt = 0
+        count = 20
+        if params:
+            try:
+                count = int(params[0])
+            except ValueError:
+                self.writeerror('Count must be a number')
+                return
+        start = max(len(self.history) - count, 0)
         self.writeline('Command history\n')
-        for line in self.history:
-            cnt = cnt + 1
-            self.writeline("%-5d : %s" % (cnt, ''.join(line)))
+        for cnt, line in enumerate(self.history[start:]):
+            self.writeline("%-5d : %s" % (start + cnt + 1, ''.join(line)))
+
+    def cmdCACHE(self, params):
+        """[clear]
+        Show command result cache statistics
+        With clear, forget all cached results, if allowed.
+        """
+        cache = self.get_result_cache()
+        if params and params[0].lower() == 'clear':
+            if not self.may_clear_cache():
+                self.writeerror('Clearing the shared cache is not allowed')
+                return
+            cache.clear()
+            self.writeline('Cache cleared')
+            return
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses'] + stats['collapsed']
+        self.writeline('Entries   : %(size)d of %(maxsize)d' % stats)
+        self.writeline('Hits      : %(hits)d' % stats)
+        self.writeline('Misses    : %(misses)d' % stats)
+        self.writeline('Collapsed : %(collapsed)d' % stats)
+        self.writeline('Evictions : %(evictions)d' % stats)
+        if lookups:
+            self.writeline('Hit rate  : %.1f%%' % (100.0 * (stats['hits'] + stats['collapsed']) / lookups))
+    cmdCACHE.hidden = True
+
+    def cmdPROFILE(self, params):
+        """[<command> [<runs>] | show <command> [<sort>] | dump <command> <file> | clear]
+        Profile commands
+        With a command name, profile its next runs (default 1).
+        Without parameters, list the profiled commands.
+        show prints a command's statistics, sorted by cumulative
+        time unless another pstats sort key is given.
+        dump writes them to a file for pstats or a profile viewer.
+        clear forgets all statistics and stops profiling.
+        """
+        if not self.may_profile():
+            self.writeerror("Unknown command 'PROFILE'")
+            return
+        profiler = self.get_profiler()
+        action = params and params[0].lower() or ''
+        if action in ('show', 'dump') and len(params) > 1:
+            matches = self.match_command(params[1].upper())
+            cmd = len(matches) == 1 and matches[0] or params[1].upper()
+        if not params:
+            for (cmd, runs) in profiler.commands():
+                self.writeline('%-20s %d runs profiled' % (cmd, runs))
+            for (cmd, runs) in sorted(profiler.armed.items()):
+                self.writeline('%-20s next %d runs to profile' % (cmd, runs))
+        elif action == 'clear':
+            profiler.disarm()
+            profiler.clear()
+            self.writeline('Profiles cleared')
+        elif action == 'show' and len(params) > 1:
+            try:
+                report = profiler.report(cmd, *params[2:3])
+            except KeyError:
+                self.writeerror('Unknown sort key %s' % params[2])
+                return
+            if report is None:
+                self.writeerror('%s has not been profiled' % cmd)
+                return
+            for line in report.splitlines():
+                self.writeline(line)
+        elif action == 'dump' and len(params) > 2:
+            name = params[2]
+            if not self.PROFILE_DIR:
+                self.writeerror('Dumping profiles is not enabled')
+                return
+            if os.path.basename(name) != name or name.startswith('.'):
+                self.writeerror('Give a plain file name, without a directory')
+                return
+            filename = os.path.join(self.PROFILE_DIR, name)
+            try:
+                if not profiler.dump(cmd, filename):
+                    self.writeerror('%s has not been profiled' % cmd)
+                    return
+            except IOError, e:
+                self.writeerror('Cannot write %s: %s' % (filename, e.strerror))
+                return
+            self.writeline('Profile of %s written to %s' % (cmd, filename))
+        else:
+            matches = self.match_command(params[0].upper())
+            if len(matches) != 1:
+                self.writeerror("Unknown command '%s'" % params[0])
+                return
+            try:
+                runs = int(params[1]) if len(params) > 1 else 1
+            except ValueError:
+                self.writeerror('Runs must be a number')
+                return
+            profiler.arm(matches[0], runs)
+            self.writeline('Profiling the next %d runs of %s' % (runs, matches[0]))
+    cmdPROFILE.hidden = True
+
+    def cmdJOBS(self, params):
+        """
+        List background jobs
+        Commands ending in & run in the background.
+        """
+        for number in sorted(self.jobs.keys()):
+            job = self.jobs[number]
+            self.writeline('[%d] %-8s %s' % (number, job.status(), job.cmdline))
+
+    def cmdFG(self, params):
+        """[<job>]
+        Wait for a background job
+        Shows the output of the most recent, or given, background job
+        until it is done.  Ctrl-C kills the job.
+        """
+        job = self.find_job(params)
+        if job is None:
+            return
+        self.writeline(job.cmdline)
+        self.interrupted = False
+        job.foreground = True
+        try:
+            while not job.done:
+                if self.interrupted or self.eof:
+                    self.kill_job(job)
+                    self.write('^C' + chr(10))
+                    while self.getc(block=False) not in ('', chr(3)):
+                        pass
+                    self.interrupted = False
+                    break
+                self.sleep(0.1)
+        finally:
+            job.foreground = False
+
+    def cmdKILL(self, params):
+        """<job>
+        Stop a background job
+        """
+        if not params:
+            self.writeerror('Which job?')
+            return
+        job = self.find_job(params)
+        if job is not None:
+            self.kill_job(job)
 
 # ----------------------- Command Line Processor Engine --------------------
 
+    def match_command(self, cmd):
+        """Return the list of COMMANDS keys matching the upper case cmd.
+        If abbreviations are allowed, aliases of a single command count as one match."""
+        if self.COMMANDS.has_key(cmd):
+            return [cmd]
+        if not self.ABBREVIATE_COMMANDS:
+            return []
+        matches = []
+        methods = []
+        for name in self._command_trie.complete(cmd):
+            if name not in self.COMMANDS:
+                # Deleted from this session, the trie is the class's.
+                continue
+            method = self.COMMANDS[name]
+            if method not in methods:
+                methods.append(method)
+                matches.append(name)
+        return matches
+
+    def make_output_filter(self, pipeline):
+        """Return a FilterChain for the list of filter specs (each a list of name and parameters).
+        Raises ValueError if the pipeline is not valid."""
+        filters = []
+        for spec in pipeline:
+            if not spec:
+                raise ValueError("Missing filter after '|'")
+            name = spec[0].upper()
+            if name not in self.OUTPUT_FILTERS:
+                names = [n for n in self.OUTPUT_FILTERS.keys() if n.startswith(name)]
+                if len(names) != 1:
+                    raise ValueError("Unknown filter '%s'" % name)
+                name = names[0]
+            try:
+                filters.append(self.OUTPUT_FILTERS[name](spec[1:]))
+            except ValueError, e:
+                raise ValueError("%s: %s" % (name, e))
+        return FilterChain(filters)
+
+    def call_command(self, cmd, params):
+        """Call the command's method, or return its cached output if it has a cache TTL."""
+        method = self.COMMANDS[cmd]
+        ttl = getattr(method, 'cache_ttl', None)
+        if not ttl:
+            return method(params)
+        key = self.result_cache_key(cmd, method, params)
+        return iter(self.get_result_cache().get(key, ttl, lambda: self.capture_output(method, params), self.sleep))
+
+    def result_cache_key(self, cmd, method, params):
+        """Return the key of the command's result in the result cache.  Aliases
+        share their command's results; handler classes sharing the cache don't."""
+        name = getattr(method, 'command_name', cmd).upper()
+        return (self.__class__, name, tuple([str(p) for p in params]))
+
+    def capture_output(self, method, params):
+        """Call a command's method, returning the list of lines it writes instead of writing them."""
+        task = self.current_task()
+        saved = self._captures.get(task)
+        lines = self.own('_captures')[task] = []
+        try:
+            result = method(params)
+            if hasattr(result, 'next'):
+                for line in result:
+                    if line.endswith(chr(10)):
+                        line = line[:-1]
+                    lines.append(line)
+            elif result is not None:
+                self.writeresult(result)
+        finally:
+            if saved is None:
+                del self._captures[task]
+            else:
+                self._captures[task] = saved
+        return lines
+
+    def get_result_cache(self):
+        """Return the result cache shared by every session of this class."""
+        if self.result_cache is None:
+            _shared_lock.acquire()
+            try:
+                # Sessions starting at once must all get the same cache.
+                if self.result_cache is None:
+                    self.__class__.result_cache = ResultCache()
+            finally:
+                _shared_lock.release()
+        return self.result_cache
+
+    def get_profiler(self):
+        """Return the command profiler shared by every session of this class."""
+        if self.profiler is None:
+            _shared_lock.acquire()
+            try:
+                if self.profiler is None:
+                    self.__class__.profiler = CommandProfiler()
+            finally:
+                _shared_lock.release()
+        return self.profiler
+
+    def may_clear_cache(self):
+        """Return True if this session may empty the result cache every session shares.
+        Override to allow only some users, for example by self.username."""
+        return self.CACHE_CLEAR
+
+    def may_profile(self):
+        """Return True if this session may use the profile command.
+        Override to allow only some users, for example by self.username."""
+        return self.PROFILE_COMMANDS
+
+    def run_gmcp_queue(self):
+        """Run the queued GMCP commands until none are left."""
+        while True:
+            _shared_lock.acquire()
+            try:
+                queue = self._gmcp_queue
+                if not queue:
+                    # Done, the next command starts a new task.
+                    self._gmcp_queue = None
+                    return
+                request = queue.pop(0)
+            finally:
+                _shared_lock.release()
+            self.run_gmcp_command(*request)
+
+    def run_gmcp_command(self, request_id, name, params):
+        """Run a command for a GMCP client, sending back its result and any output lines."""
+        reply = {'id': request_id, 'ok': False}
+        matches = self.match_command(name.upper())
+        if not self.logged_in:
+            reply['error'] = 'Not logged in'
+        elif len(matches) != 1:
+            reply['error'] = "Unknown command '%s'" % name
+        else:
+            task = self.current_task()
+            lines = self.own('_captures')[task] = []
+            try:
+                try:
+                    result = self.call_command(matches[0], [unicode(p).encode('utf-8') for p in params])
+                    if hasattr(result, 'next'):
+                        result = [line.rstrip(chr(10)) for line in result]
+                    reply['ok'] = True
+                    reply['result'] = result
+                except Exception, e:
+                    log.exception('Error calling %s for GMCP.', name)
+                    reply['error'] = str(e)
+            finally:
+                del self._captures[task]
+            reply['output'] = lines
+        self.gmcp_send('Command.Result', reply)
+
+    def run_command(self, cmd, params, pipeline=()):
+        """Run the command with its output passed through the pipeline.
+        Return False if the session should end."""
+        if pipeline:
+            try:
+                self.output_filter = self.make_output_filter(pipeline)
+            except ValueError, e:
+                self.writeerror(str(e))
+                return True
+        self.interrupted = False
+        if self.PAGER and self.DOECHO and self.window_known and not self.batch:
+            self.pager_rows = 0
+        started = time.time()
+        try:
+            try:
+                profiler = self.profiler
+                if profiler is not None and profiler.armed and profiler.claim(cmd):
+                    profiler.runcall(cmd, self.dispatch_command, cmd, params)
+                else:
+                    self.dispatch_command(cmd, params)
+            except OutputAborted:
+                pass
+            except EOFError:
+                raise
+            except:
+                log.exception('Error calling %s.', cmd)
+                self.command_failed = True
+                self.count('command_errors_total', labels={'command': cmd})
+                (t, p, tb) = sys.exc_info()
+                # The error isn't part of the output to filter, finish that first.
+                self.finish_output_filter()
+                try:
+                    if self.handleException(t, p, tb):
+                        return False
+                except OutputAborted:
+                    # The user quit the pager during a long traceback.
+                    pass
+        finally:
+            self.finish_output_filter()
+            self.pager_rows = None
+            self.count('commands_total', labels={'command': cmd})
+            self.observe('command_seconds', time.time() - started, {'command': cmd})
+        return True
+
+    def finish_output_filter(self):
+        """Write what the command's output filters still hold, and stop filtering."""
+        chain = self.output_filter
+        if chain is None:
+            return
+        self.output_filter = None
+        try:
+            for line in chain.finish():
+                self.writeline(line)
+        except OutputAborted:
+            pass
+
+    def dispatch_command(self, cmd, params):
+        """Call the command and write its output."""
+        result = self.call_command(cmd, params)
+        if hasattr(result, 'next'):
+            # An iterator or generator of output lines.
+            self.writestream(result)
+        elif result is not None:
+            self.writeresult(result)
+
+    def run_background(self, cmd, params, pipeline=()):
+        """Start the command as a background job, its output written as messages."""
+        chain = None
+        if pipeline:
+            try:
+                chain = self.make_output_filter(pipeline)
+            except ValueError, e:
+                self.writeerror(str(e))
+                return
+        self.job_counter += 1
+        job = Job(self.job_counter, self.raw_input, chain)
+        self.own('jobs')[job.number] = job
+        self.writeresponse('[%d] %s' % (job.number, job.cmdline))
+        job.task = self.spawn(self._run_job, job, cmd, params)
+
+    def _run_job(self, job, cmd, params):
+        """Run a background job's command, in the job's own task."""
+        job.task = self.current_task()
+        started = time.time()
+        try:
+            try:
+                result = self.call_command(cmd, params)
+                if hasattr(result, 'next'):
+                    try:
+                        for line in result:
+                            if line.endswith(chr(10)):
+                                line = line[:-1]
+                            self.writeline(line)
+                    finally:
+                        close = getattr(result, 'close', None)
+                        if close is not None:
+                            close()
+                elif result is not None:
+                    self.writeresult(result)
+                if job.output_filter is not None:
+                    chain = job.output_filter
+                    job.output_filter = None
+                    for line in chain.finish():
+                        self.writeline(line)
+            except OutputAborted:
+                pass
+            except Exception:
+                log.exception('Error calling %s in the background.', cmd)
+                self.count('command_errors_total', labels={'command': cmd})
+                (t, p, tb) = sys.exc_info()
+                self.handleException(t, p, tb)
+        finally:
+            self.count('commands_total', labels={'command': cmd})
+            self.observe('command_seconds', time.time() - started, {'command': cmd})
+            job.done = True
+            self.jobs.pop(job.number, None)
+            if not job.foreground and not self.session_ended:
+                self.writemessage('[%d] %-8s %s' % (job.number, job.status(), job.cmdline))
+
+    def current_job(self):
+        """Return the background job the caller is running in, or None."""
+        task = self.current_task()
+        for job in self.jobs.values():
+            if job.task is task:
+                return job
+        return None
+
+    def kill_job(self, job):
+        """Stop a background job.  It stops at its next line of output if it can't be stopped at once."""
+        job.killed = True
+        if not job.done and job.task is not None:
+            self.kill_task(job.task)
+
+    def find_job(self, params):
+        """Return the job numbered by the first parameter (with an optional %), or the most recent job."""
+        if not self.jobs:
+            self.writeerror('No background jobs')
+            return None
+        if not params:
+            return self.jobs[max(self.jobs.keys())]
+        try:
+            job = self.jobs.get(int(params[0].lstrip('%')))
+        except ValueError:
+            job = None
+        if job is None:
+            self.writeerror("No job '%s'" % params[0])
+        return job
+
+    #abstractmethod
+    def spawn(self, func, *args):
+        """Run func(*args) concurrently with this session, return the thread or greenlet"""
+        raise NotImplementedError("Please Implement the spawn method")
+
+    #abstractmethod
+    def current_task(self):
+        """Return the thread or greenlet running the caller"""
+        raise NotImplementedError("Please Implement the current_task method")
+
+    #abstractmethod
+    def kill_task(self, task):
+        """Stop a task started by spawn, if the implementation can"""
+        raise NotImplementedError("Please Implement the kill_task method")
+
     def handleException(self, exc_type, exc_param, exc_tb):
         "Exception handler (False to abort)"
         self.writeline(''.join( traceback.format_exception(exc_type, exc_param, exc_tb) ))
@@ -1005,50 +3067,118 @@ class TelnetHandlerBase(SocketServer.BaseRequestHandler):
                 password = self.readline(echo=False, prompt=self.PROMPT_PASS, use_history=False)
                 if self.DOECHO:
                     self.write("\n")
+            address = self.client_address[0]
+            if self.authThrottle and self.authThrottle.blocked(address):
+                log.info('Too many failed logins from %s, not authenticating.', address)
+                self.username = None
+                return False
             try:
-                self.authCallback(username, password)
+                self.authenticate(username, password)
             except:
+                if self.authThrottle:
+                    self.authThrottle.failure(address)
                 self.username = None
                 return False
             else:
                 # Successful authentication
+                if self.authThrottle:
+                    self.authThrottle.success(address)
                 self.username = username
                 return True
         else:
             # No authentication desired
             self.username = None
             return True
-            
+
+    def authenticate(self, username, password):
+        '''Call authCallback, consulting the authCache and honoring authTimeout.
+        Raises if authentication fails.'''
+        if self.authCache and self.authCache.check(username, password):
+            return
+        if self.authTimeout is None:
+            self.authCallback(username, password)
+        else:
+            self.run_blocking(self.authTimeout, self.authCallback, username, password)
+        if self.authCache:
+            self.authCache.store(username, password)
+
+    #abstractmethod
+    def run_blocking(self, timeout, func, *args):
+        """Call func(*args) without blocking other sessions, wait at most timeout seconds"""
+        # A worker thread, or the green hub's thread pool.
+        raise NotImplementedError("Please Implement the run_blocking method")
 
     def handle(self):
         "The actual service to which the user has connected."
-        if self.TELNET_ISSUE:
-            self.writeline(self.TELNET_ISSUE)
-        if not self.authentication_ok():
-            return
-        if self.DOECHO:
-            self.writeline(self.WELCOME)
-
-        self.session_start()
-        while self.RUNSHELL:
-            raw_input = self.readline(prompt=self.PROMPT).strip()
-            self.input = self.input_reader(self, raw_input)
-            self.raw_input = self.input.raw
-            if self.input.cmd:
-                cmd = self.input.cmd.upper()
-                params = self.input.params
-                if self.COMMANDS.has_key(cmd):
-                    try:
-                        self.COMMANDS[cmd](params)
-                    except:
-                        log.exception('Error calling %s.' % cmd)
-                        (t, p, tb) = sys.exc_info()
-                        if self.handleException(t, p, tb):
-                            break
-                else:
-                    self.writeerror("Unknown command '%s'" % cmd)
+        try:
+            if self.session_ended:
+                # The implicit TLS handshake failed in setup().
+                return
+            if self.TLS_REQUIRED and not self.tls_wait():
+                log.info("Refused session from %s without TLS.", self.client_address[0])
+                self.writeline("This server requires TLS.")
+                return
+            if self.TELNET_ISSUE and not self.batch:
+                self.writeline(self.TELNET_ISSUE)
+            if not self.authentication_ok():
+                return
+            self.logged_in = True
+            if self.detached_sessions is not None and self.username:
+                session = self.detached_sessions.claim(self.username)
+                if session is not None:
+                    self.continue_session(session)
+                    return
+            if self.history_store is not None and self.username:
+                self.history = self.history_store.load(self.username, self.HISTORY_SIZE)
+            if self.recorder is not None and self.recorder.wants(self):
+                self.recording = self.recorder.open(self)
+            if self.DOECHO and not self.batch:
+                self.writeline(self.WELCOME)
+
+            self.session_start()
+            while self.RUNSHELL:
+                raw_input = self.readline(prompt=self.PROMPT, use_completion=True).strip()
+                self.command_failed = False
+                self.input = self.input_reader(self, raw_input)
+                self.raw_input = self.input.raw
+                if self.input.cmd:
+                    cmd = self.input.cmd.upper()
+                    params = self.input.params
+                    pipeline = []
+                    background = getattr(self.input, 'background', False)
+                    parts = self.input.parts
+                    if background:
+                        parts = parts[:-1]
+                        params = parts[1:]
+                    pipes = [idx for idx in getattr(self.input, 'pipes', []) if idx < len(parts)]
+                    if pipes:
+                        # Split off the trailing "| filter params" specs.
+                        params = parts[1:pipes[0]]
+                        pipeline = [parts[start+1:end] for (start, end) in zip(pipes, pipes[1:] + [len(parts)])]
+                    matches = self.match_command(cmd)
+                    if len(matches) > 1:
+                        self.writeerror("Ambiguous command '%s' (%s)" % (cmd, ', '.join(matches)))
+                    elif matches and background:
+                        self.run_background(matches[0], params, pipeline)
+                    elif matches:
+                        if not self.run_command(matches[0], params, pipeline):
+                            self.RUNSHELL = False
+                    else:
+                        self.writeerror("Unknown command '%s'" % cmd)
+                if self.batch:
+                    self.write('%s %s\n' % (self.BATCH_END, self.command_failed and 'ERROR' or 'OK'))
+        except EOFError:
+            log.debug("Client disconnected")
         log.debug("Exiting handler")
 
+    def continue_session(self, session):
+        "Carry a reattached session's input and output until it ends or this connection drops."
+        session.reattach(self)
+        while not session.session_ended:
+            if self.eof:
+                session.connection_lost()
+                break
+            self.sleep(1)
 
 
 # vim: set syntax=python ai showmatch:
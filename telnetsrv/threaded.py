@@ -4,11 +4,80 @@
 import threading
 import time
 import select
+import socket
+import ssl
 
-from telnetsrvlib import TelnetHandlerBase, command
+from telnetsrvlib import TelnetHandlerBase, command, SESSION_CLOSED
+from auth import call_with_timeout
+
+# Serializes changes of the process wide thread stack size
+_stack_size_lock = threading.Lock()
+
+def start_thread(func, args=(), stack_size=None):
+    '''Start a daemon thread running func(*args), with a stack of stack_size bytes if given.'''
+    thread = threading.Thread(target=func, args=args)
+    thread.setDaemon(True)
+    if not stack_size:
+        thread.start()
+        return thread
+    _stack_size_lock.acquire()
+    try:
+        previous = threading.stack_size(stack_size)
+        try:
+            thread.start()
+        finally:
+            threading.stack_size(previous)
+    finally:
+        _stack_size_lock.release()
+    return thread
+
+class TLSSocket(object):
+    """An SSLSocket read by one thread while others write to it.
+    OpenSSL doesn't let two threads use a connection at once, so the
+    socket is non-blocking, reads wait for data without the lock, and
+    reads and writes take turns."""
+    def __init__(self, sock):
+        self._sock = sock
+        self._lock = threading.Lock()
+        sock.setblocking(False)
+
+    def recv(self, size):
+        while True:
+            if not self._sock.pending():
+                select.select([self._sock], [], [])
+            self._lock.acquire()
+            try:
+                return self._sock.recv(size)
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                    select.select([], [self._sock], [])
+                elif e.args[0] != ssl.SSL_ERROR_WANT_READ:
+                    raise
+            finally:
+                self._lock.release()
+
+    def sendall(self, data):
+        offset = 0
+        while offset < len(data):
+            self._lock.acquire()
+            try:
+                # Returns 0 when the socket buffer is full.
+                sent = self._sock.send(data[offset:offset + 16384])
+            finally:
+                self._lock.release()
+            if not sent:
+                select.select([], [self._sock], [])
+            offset += sent
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
 
 class TelnetHandler(TelnetHandlerBase):
     "A telnet server handler using Threading"
+    BACKEND = "threaded"
+    # Stack size in bytes of the threads a session starts (input and background
+    # jobs), None for the system default.  At least 32768.
+    THREAD_STACK_SIZE = None
     def __init__(self, request, client_address, server):
         # This is the cooked input stream (list of charcodes)
         self.cookedq = []   
@@ -24,9 +93,7 @@ class TelnetHandler(TelnetHandlerBase):
         '''Called after instantiation'''
         TelnetHandlerBase.setup(self)
         # Spawn a thread to handle socket input
-        self.thread_ic = threading.Thread(target=self.inputcooker)
-        self.thread_ic.setDaemon(True)
-        self.thread_ic.start()
+        self.thread_ic = start_thread(self.inputcooker, stack_size=self.THREAD_STACK_SIZE)
         # Note that inputcooker exits on EOF
         
         # Sleep for 0.5 second to allow options negotiation
@@ -50,10 +117,17 @@ class TelnetHandler(TelnetHandlerBase):
             time.sleep(0.05)
         self.IQUEUELOCK.acquire()
         ret = self.cookedq[0]
-        self.cookedq = self.cookedq[1:]
+        if ret is not SESSION_CLOSED:
+            self.cookedq = self.cookedq[1:]
         self.IQUEUELOCK.release()
+        if ret is SESSION_CLOSED:
+            raise EOFError
         return ret
 
+    def wait_readable(self, fileno, timeout):
+        """Wait at most timeout seconds for the file descriptor to be readable"""
+        return select.select([fileno], [], [], timeout)[0] != []
+
     def inputcooker_socket_ready(self):
         """Indicate that the socket is ready to be read"""
         return select.select([self.sock.fileno()], [], [], 0) != ([], [], [])
@@ -87,3 +161,39 @@ class TelnetHandler(TelnetHandlerBase):
         TelnetHandlerBase.writecooked(self, text)
         self.OQUEUELOCK.release()
 
+
+    # -- Threaded helper functions --
+
+    def run_blocking(self, timeout, func, *args):
+        """Call func(*args) on auth.default_pool, wait at most timeout seconds"""
+        return call_with_timeout(timeout, func, *args)
+
+    def sleep(self, seconds):
+        """Pause this thread"""
+        time.sleep(seconds)
+
+    def spawn(self, func, *args):
+        """Run func(*args) in a new daemon thread"""
+        return start_thread(func, args, self.THREAD_STACK_SIZE)
+
+    def current_task(self):
+        """Return the running thread"""
+        return threading.current_thread()
+
+    def kill_task(self, task):
+        """Threads can't be stopped, the job stops at its next line of output"""
+        pass
+
+    def tls_wrap(self, sock):
+        """Return the socket wrapped with tls_context, after the handshake"""
+        tls = self.tls_context.wrap_socket(socket.socket(_sock=sock), server_side=True,
+                                           do_handshake_on_connect=False)
+        return TLSSocket(self.tls_handshake(tls))
+
+    def tls_release(self):
+        """Send the output held while TLS was starting (with locking)"""
+        self.OQUEUELOCK.acquire()
+        try:
+            TelnetHandlerBase.tls_release(self)
+        finally:
+            self.OQUEUELOCK.release()
@@ -0,0 +1,34 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""TLS for telnet sessions
+
+server_context() makes the ssl.SSLContext to set as the handler's
+tls_context class member.  Share one context between every listener of
+the process: it keeps the server side session cache and the key of the
+session tickets, so an operator reconnecting resumes the TLS session
+instead of doing a full handshake.  context.session_stats() counts the
+resumed sessions ('hits').
+
+Python 2 can't change the cache size or the ticket key, OpenSSL's
+defaults are used: 20480 sessions, a ticket key made with the context.
+"""
+
+import ssl
+
+# Protocol versions too old to accept
+NO_OLD_PROTOCOLS = (getattr(ssl, 'OP_NO_SSLv2', 0) | getattr(ssl, 'OP_NO_SSLv3', 0) |
+                    getattr(ssl, 'OP_NO_TLSv1', 0) | getattr(ssl, 'OP_NO_TLSv1_1', 0))
+
+
+def server_context(certfile, keyfile=None, password=None, ciphers=None):
+    '''Return an SSLContext for the server with the certificate chain in
+    certfile and its private key in keyfile (or also in certfile).'''
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= (NO_OLD_PROTOCOLS | ssl.OP_CIPHER_SERVER_PREFERENCE |
+                        getattr(ssl, 'OP_SINGLE_ECDH_USE', 0))
+    # Keep session tickets on for resumption.
+    context.options &= ~getattr(ssl, 'OP_NO_TICKET', 0)
+    context.load_cert_chain(certfile, keyfile, password)
+    if ciphers:
+        context.set_ciphers(ciphers)
+    return context
@@ -0,0 +1,185 @@
+# license: LGPL
+# For distribution, see the COPYING.txt file that accompanies this file.
+"""Per-session protocol traces
+
+Set a TraceWriter as the handler's tracer class member to record the
+raw traffic of chosen sessions, to debug one client without turning on
+debug logging for the whole server.  The sessions' records are queued
+and written by a background thread, so tracing doesn't wait for the
+disk.  When the queue is full records are dropped, and the number lost
+is recorded in their place.  The end of a session is never dropped, it
+waits for room so that the trace's file gets closed.
+
+Each trace file holds a series of records, each a header packed as
+"!dcI" (time, kind, length of the data) followed by the data:
+
+    I   Bytes received from the client
+    O   Bytes sent to the client
+    C   Telnet command handled, the command byte followed by the option
+        byte, or for SE the subnegotiation data
+    D   Number of records dropped, as a "!I" packed count
+    E   End of the session
+
+Print a trace with:
+
+    python -m telnetsrv.trace FILE
+"""
+
+import os
+import Queue
+import struct
+import sys
+import threading
+import time
+
+HEADER = struct.Struct('!dcI')
+
+TRACE_IN = 'I'
+TRACE_OUT = 'O'
+TRACE_COMMAND = 'C'
+TRACE_DROPPED = 'D'
+TRACE_END = 'E'
+
+
+class SessionTrace(object):
+    '''The trace of one session.  Records are handed to the TraceWriter.'''
+    def __init__(self, writer, filename):
+        self.writer = writer
+        self.filename = filename
+        self.dropped = 0
+
+    def record(self, kind, data, block=False):
+        if self.dropped:
+            if not self.writer._put((self, time.time(), TRACE_DROPPED, struct.pack('!I', self.dropped)), block):
+                self.dropped += 1
+                return
+            self.dropped = 0
+        if not self.writer._put((self, time.time(), kind, data), block):
+            self.dropped += 1
+
+    def received(self, data):
+        self.record(TRACE_IN, data)
+
+    def sent(self, data):
+        self.record(TRACE_OUT, data)
+
+    def command(self, cmd, data):
+        self.record(TRACE_COMMAND, cmd + data)
+
+    def close(self):
+        # The writer closes the file when the end arrives, so wait for room.
+        self.record(TRACE_END, '', block=True)
+
+
+class TraceWriter(object):
+    '''Writes session traces to files in a directory from a background thread.
+
+    Only sessions from the client addresses in the addresses set are
+    traced, or all sessions if it is None.  At most queue_size records
+    wait to be written.'''
+    def __init__(self, directory, addresses=None, queue_size=10000):
+        self.directory = directory
+        self.addresses = addresses
+        self.dropped = 0
+        self._queue = Queue.Queue(queue_size)
+        self._files = {}
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def wants(self, handler):
+        '''Should this session be traced?'''
+        return self.addresses is None or handler.client_address[0] in self.addresses
+
+    def open(self, handler):
+        '''Return a new SessionTrace for the handler's session.'''
+        self._lock.acquire()
+        try:
+            self._counter += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            name = '%s-%d-%s.trace' % (time.strftime('%Y%m%d-%H%M%S'), self._counter,
+                                       str(handler.client_address[0]).replace(':', '_'))
+        finally:
+            self._lock.release()
+        return SessionTrace(self, os.path.join(self.directory, name))
+
+    def _put(self, item, block=False):
+        try:
+            self._queue.put(item, block)
+            return True
+        except Queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self):
+        '''Wait until every queued record is written.'''
+        if self._thread is not None:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self._write(*item)
+            except (IOError, OSError):
+                pass
+            finally:
+                self._queue.task_done()
+
+    def _write(self, trace, when, kind, data):
+        f = self._files.get(trace)
+        if f is None:
+            f = self._files[trace] = open(trace.filename, 'ab')
+        try:
+            f.write(HEADER.pack(when, kind, len(data)))
+            f.write(data)
+        finally:
+            if kind == TRACE_END:
+                # Closed even if the write failed.
+                del self._files[trace]
+                f.close()
+        if kind != TRACE_END and self._queue.empty():
+            f.flush()
+
+
+def read(filename):
+    '''Yield the (time, kind, data) records of a trace file.'''
+    f = open(filename, 'rb')
+    try:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            (when, kind, length) = HEADER.unpack(header)
+            yield (when, kind, f.read(length))
+    finally:
+        f.close()
+
+
+def format_record(when, kind, data, start=0):
+    '''Return a record as a line of text.'''
+    from telnetsrvlib import CMDS, SE, WILL, WONT, DO, DONT
+    if kind == TRACE_COMMAND:
+        text = CMDS.get(data[:1], repr(data[:1]))
+        if data[:1] in (WILL, WONT, DO, DONT):
+            text = '%s %s' % (text, CMDS.get(data[1:], repr(data[1:])))
+        elif data[:1] == SE and data[1:]:
+            text = '%s %s %r' % (text, CMDS.get(data[1], repr(data[1])), data[2:])
+    elif kind == TRACE_DROPPED:
+        text = '%d records dropped' % struct.unpack('!I', data)
+    elif kind == TRACE_END:
+        text = 'end of session'
+    else:
+        text = repr(data)
+    return '%10.3f %s %s' % (when - start, kind, text)
+
+
+if __name__ == '__main__':
+    start = None
+    for (when, kind, data) in read(sys.argv[1]):
+        if start is None:
+            start = when
+        print format_record(when, kind, data, start)